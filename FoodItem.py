@@ -10,6 +10,7 @@ class FoodItem:
         self.carbs = carbs  # 碳水(克)
         self.grams = grams
         self.notion_id = None  # Notion页面ID
+        self.last_edited_time = None  # Notion页面最后编辑时间(ISO 8601)
 
     def __str__(self):
         """字典格式输出食物信息"""
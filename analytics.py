@@ -0,0 +1,189 @@
+"""基于本地条目镜像的饮食统计，不访问Notion
+
+用法:
+    python analytics.py backfill              # 从Notion补录历史条目(只需运行一次)
+    python analytics.py daily [--days 30] [--window 7]
+    python analytics.py weekly [--weeks 12]
+    python analytics.py top [--days 30] [-k 10]
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from food_database import ENTRY_INDEX_BACKFILLED, NUTRIENT_FIELDS, LocalFoodDatabase
+from notion import entry_foods, notion_timestamp
+
+
+# 按该时区(相对UTC的小时数)划分日期，默认北京时间
+ANALYTICS_UTC_OFFSET = float(os.getenv("ANALYTICS_UTC_OFFSET", "8"))
+
+# 每克宏量营养素提供的热量(千卡)
+MACRO_KCAL = np.array([4.0, 9.0, 4.0])  # 蛋白质, 脂肪, 碳水
+
+DAY = 86400
+
+
+def backfill(local_db, notion):
+    """把Notion主数据库中已关联食物的条目补录到本地镜像
+
+    需要先同步本地食物库；没有关联食物的条目跳过，关联了本地没有的食物的条目
+    记为missing。没有missing时标记反向索引已完整，之后更新食物不再读取Notion的关联。
+    return: {"recorded": 记录数, "skipped": 跳过数, "missing": 缺少食物的条目数}"""
+    entries = []
+    skipped = 0
+    missing = 0
+    for entry in notion.iter_all_entries():
+        try:
+            notion_ids, quantities = entry_foods(entry)
+        except (KeyError, IndexError, ValueError):
+            skipped += 1
+            continue
+        if not notion_ids:
+            skipped += 1
+            continue
+        food_items = local_db.get_food_items_by_ids(notion_ids)
+        if food_items is None:
+            missing += 1
+            continue
+        logged_at = notion_timestamp(entry.get("created_time"))
+        entries.append((entry["id"], food_items, quantities, logged_at))
+    local_db.record_entries(entries)
+    if not missing:
+        local_db.set_sync_state(ENTRY_INDEX_BACKFILLED, str(time.time()))
+    return {"recorded": len(entries), "skipped": skipped, "missing": missing}
+
+
+def load_entries(local_db, start=None, end=None):
+    """return: (记录时间数组 shape (n,), 营养合计数组 shape (n, 4))，列顺序同NUTRIENT_FIELDS"""
+    data = np.array(local_db.get_entry_totals(start, end), dtype=np.float64)
+    data = data.reshape(-1, 1 + len(NUTRIENT_FIELDS))
+    return data[:, 0], np.nan_to_num(data[:, 1:])
+
+
+def day_numbers(timestamps, utc_offset=ANALYTICS_UTC_OFFSET):
+    """Unix时间戳 -> 当地日期距1970-01-01的天数"""
+    return np.floor((timestamps + utc_offset * 3600) / DAY).astype(np.int64)
+
+
+def daily_totals(timestamps, values, utc_offset=ANALYTICS_UTC_OFFSET):
+    """按天汇总，日期连续，没有记录的日期为0
+
+    return: (日期数组 datetime64[D], 每日合计 shape (天数, 列数))"""
+    if len(timestamps) == 0:
+        return np.array([], dtype="datetime64[D]"), np.zeros((0, values.shape[1]))
+    days = day_numbers(timestamps, utc_offset)
+    first = days.min()
+    index = days - first
+    length = index.max() + 1
+    totals = np.stack(
+        [
+            np.bincount(index, weights=values[:, i], minlength=length)
+            for i in range(values.shape[1])
+        ],
+        axis=1,
+    )
+    dates = np.arange(first, first + length).astype("datetime64[D]")
+    return dates, totals
+
+
+def rolling_mean(values, window):
+    """沿第0轴的滑动平均；开头不足window行时按已有行数平均"""
+    sums = np.cumsum(values, axis=0)
+    sums[window:] -= sums[:-window].copy()
+    counts = np.minimum(np.arange(1, len(values) + 1), window)
+    return sums / counts.reshape((-1,) + (1,) * (values.ndim - 1))
+
+
+def weekly_totals(dates, daily):
+    """把连续的每日合计按周(周一开始)汇总
+
+    return: (每周周一的日期, 每周合计, 每周包含的天数)"""
+    if len(dates) == 0:
+        return dates, daily, np.zeros(0, dtype=np.int64)
+    days = dates.astype(np.int64)
+    # 1970-01-01是周四
+    weeks = (days + 3) // 7
+    index = weeks - weeks[0]
+    length = index[-1] + 1
+    totals = np.stack(
+        [
+            np.bincount(index, weights=daily[:, i], minlength=length)
+            for i in range(daily.shape[1])
+        ],
+        axis=1,
+    )
+    day_counts = np.bincount(index, minlength=length)
+    starts = (np.arange(weeks[0], weeks[0] + length) * 7 - 3).astype("datetime64[D]")
+    return starts, totals, day_counts
+
+
+def macro_split(totals):
+    """蛋白质、脂肪、碳水提供的热量占比
+
+    totals: shape (..., 4)，列顺序同NUTRIENT_FIELDS
+    return: shape (..., 3)，没有宏量营养素数据的行为0"""
+    energy = totals[..., 1:4] * MACRO_KCAL
+    total = energy.sum(axis=-1, keepdims=True)
+    return np.divide(energy, total, out=np.zeros_like(energy), where=total > 0)
+
+
+def _print_rows(labels, values, header):
+    print("".join(f"{column:>12}" for column in header))
+    for label, row in zip(labels, values):
+        print(f"{str(label):>12}" + "".join(f"{value:>12.1f}" for value in row))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="food_database.db", help="本地数据库路径")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("backfill", help="从Notion补录历史条目")
+    daily_parser = commands.add_parser("daily", help="每日合计和滑动平均")
+    daily_parser.add_argument("--days", type=int, default=30)
+    daily_parser.add_argument("--window", type=int, default=7, help="滑动平均天数")
+    weekly_parser = commands.add_parser("weekly", help="每周日均和宏量营养素占比")
+    weekly_parser.add_argument("--weeks", type=int, default=12)
+    top_parser = commands.add_parser("top", help="热量来源最多的食物")
+    top_parser.add_argument("--days", type=int, default=30)
+    top_parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    local_db = LocalFoodDatabase(args.db)
+    if args.command == "backfill":
+        from notion import Notion
+
+        notion = Notion()
+        local_db.sync_database(notion)
+        print(backfill(local_db, notion))
+        return
+
+    if args.command == "top":
+        start = time.time() - args.days * DAY
+        for name, unit, count, quantity, calories in local_db.get_top_foods(
+            start, k=args.k
+        ):
+            print(
+                f"{name}: {count}次, {quantity or 0:g}{unit}, {calories or 0:.0f}千卡"
+            )
+        return
+
+    timestamps, values = load_entries(local_db)
+    dates, daily = daily_totals(timestamps, values)
+    if args.command == "daily":
+        rolling = rolling_mean(daily[:, 0], args.window)
+        rows = np.column_stack([daily, rolling])[-args.days :]
+        header = ["日期", *NUTRIENT_FIELDS, f"{args.window}日均热量"]
+        _print_rows(dates[-args.days :], rows, header)
+    else:
+        starts, weekly, day_counts = weekly_totals(dates, daily)
+        average = weekly / np.maximum(day_counts, 1)[:, None]
+        rows = np.column_stack([average[:, 0], macro_split(weekly) * 100])
+        header = ["周一", "日均热量", "蛋白质%", "脂肪%", "碳水%"]
+        _print_rows(starts[-args.weeks :], rows[-args.weeks :], header)
+
+
+if __name__ == "__main__":
+    main()
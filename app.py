@@ -1,48 +1,294 @@
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
 from database_update import FoodAgent
+from metrics import ENTRIES_PROCESSED, METRICS_PORT, start_metrics_server
+from notion import (
+    EntryUpdate,
+    connection_stats,
+    entry_description,
+    notion_timestamp,
+    thread_request_count,
+)
+from parse_input import llm_fallback_rate
+from webhook import ALL_PENDING, WEBHOOK_SECRET, make_trigger_handler
+from work_queue import get_work_queue
 from time import time, sleep
 import logging
+import os
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
 
-def main():
+# 并发处理条目的最大线程数，1表示顺序处理
+ENTRY_WORKERS = int(os.getenv("ENTRY_WORKERS", "4"))
+# 运行模式: poll(每10秒轮询)、event(webhook触发+兜底轮询) 或 async(单进程事件循环轮询)
+RUN_MODE = os.getenv("RUN_MODE", "poll")
+# 事件模式下的兜底轮询间隔(秒)
+FALLBACK_POLL_INTERVAL = float(os.getenv("FALLBACK_POLL_INTERVAL", "300"))
+# 合并连续webhook通知的等待时间(秒)
+TRIGGER_DEBOUNCE = float(os.getenv("TRIGGER_DEBOUNCE", "1"))
 
-    food_agent = FoodAgent()
 
-    food_agent.update_food_item()
-    entries = food_agent.notion.get_pending_entries()
-    if not entries:
-        return
-    for entry in entries:
-        start_time = time()
-        food_description = entry["properties"]["食物描述"]["rich_text"][0]["text"][
-            "content"
-        ]
+def process_entry(food_agent, entry, resolved=None, job=None, parsed=None):
+    """处理单个条目，关联、总热量、数量、状态和用时合并为一次PATCH写回
+
+    resolved, parsed: 本轮合并查询得到的食物和解析结果，见FoodAgent.prefetch_nutrition
+    job: 条目对应的队列任务，写回后确认或退回重试
+
+    return: 是否处理成功"""
+    start_time = time()
+    # 条目在一个线程内处理完，只统计本线程的请求
+    requests_before = thread_request_count()
+    entry_id = entry["id"]
+    try:
+        food_description = entry_description(entry)
         print(f"处理条目: {food_description}")
-        entry_id = entry["id"]
-        quantities, food_items = food_agent.process_food_description(food_description)
+        quantities, food_items = food_agent.process_food_description(
+            food_description, sync=False, resolved=resolved, parsed=parsed
+        )
         print(f"解析结果: {quantities}, {food_items}")
-        food_agent.notion.create_associations(entry_id, food_items)
-        update_status = food_agent.notion.update_main_database(
-            entry_id, food_items, quantities
+        food_agent.notion.ensure_food_ids(food_items)
+        update = (
+            EntryUpdate()
+            .relations(food_items)
+            .totals(food_items, quantities)
+            .status("已完成")
         )
-        if update_status:
-            total_time = time() - start_time
-            food_agent.notion.update_time(entry_id, total_time)
+    except Exception as e:
+        logging.error(f"处理条目 {entry_id} 失败: {e}")
+        error = str(e)
+        update = EntryUpdate().status("出错")
+    else:
+        error = None
+    success = update.properties["状态"]["select"]["name"] == "已完成"
+    # 用时在发送前测量，与结果一起写入
+    update.elapsed(time() - start_time)
+    page = food_agent.notion.commit_entry(entry_id, update)
+    if page is None and success:
+        success = False
+        error = "写回Notion失败"
+        page = food_agent.notion.commit_entry(
+            entry_id, EntryUpdate().status("出错").elapsed(time() - start_time)
+        )
+    if success:
+        # 本地记录关联、数量和合计，食物更新和统计分析时无需再从Notion读取该条目
+        food_agent.local_db.record_entry(
+            entry_id,
+            food_items,
+            quantities,
+            notion_timestamp(entry.get("created_time")),
+        )
+    if job is not None:
+        written_time = (page or {}).get("last_edited_time")
+        if success:
+            get_work_queue().ack(job, written_time)
+        else:
+            get_work_queue().fail(job, written_time, error)
+    ENTRIES_PROCESSED.inc(status="success" if success else "error")
+    logging.info(
+        "条目 %s: Notion请求 %d 次", entry_id, thread_request_count() - requests_before
+    )
+    return success
 
 
-if __name__ == "__main__":
+def is_pending(entry):
+    """与Notion.iter_pending_entries的过滤条件一致: 非'已完成'或没有关联食物"""
+    properties = entry.get("properties", {})
+    status = (properties.get("状态") or {}).get("select") or {}
+    relation = (properties.get("食物") or {}).get("relation")
+    return status.get("name") != "已完成" or not relation
+
+
+def process_entries(food_agent, entries, workers=ENTRY_WORKERS, jobs=None):
+    """同步一次本地数据库、合并查询未知食物后并发处理条目
+
+    jobs: 与entries一一对应的队列任务"""
+    # 连接池是进程共享的，连接数只按整批统计
+    stats_before = connection_stats()
+    # 每轮只同步一次，条目处理时不再重复同步
+    food_agent.local_db.sync_database(food_agent.notion)
+    # 跨条目合并未知食物，减少LLM调用次数
+    descriptions = []
+    for entry in entries:
+        try:
+            descriptions.append(entry_description(entry))
+        except (KeyError, IndexError):
+            continue
+    parsed, resolved = food_agent.prefetch_nutrition(descriptions)
+    jobs = jobs or [None] * len(entries)
+    if workers <= 1:
+        results = [
+            process_entry(food_agent, entry, resolved, job, parsed)
+            for entry, job in zip(entries, jobs)
+        ]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    lambda entry, job: process_entry(
+                        food_agent, entry, resolved, job, parsed
+                    ),
+                    entries,
+                    jobs,
+                )
+            )
+    logging.info(f"本轮处理 {len(results)} 个条目, 成功 {sum(results)} 个")
+    stats_after = connection_stats()
+    logging.info(
+        "本轮Notion请求 %d 次, 新建连接 %d 次",
+        stats_after["requests"] - stats_before["requests"],
+        stats_after["connections"] - stats_before["connections"],
+    )
+    logging.info(f"解析LLM回退率: {llm_fallback_rate():.1%}")
+
+
+def refresh_job(food_agent, job):
+    """重新租出的任务(上次处理中途退出)先读取条目当前状态
+
+    已写回完成的直接确认，不再重复处理
+    return: 需要处理的条目页面，不需要处理时返回None"""
+    if job.attempts <= 1:
+        return job.entry
+    page = food_agent.notion.get_page(job.entry_id)
+    if page is None:
+        return job.entry
+    if not is_pending(page):
+        logging.info(f"条目 {job.entry_id} 已完成，确认任务")
+        get_work_queue().ack(job, page.get("last_edited_time"))
+        return None
+    return page
+
+
+def process_queue(food_agent, workers=ENTRY_WORKERS):
+    """租出队列中可处理的任务并处理"""
+    work_queue = get_work_queue()
+    entries = []
+    jobs = []
+    for job in work_queue.lease():
+        entry = refresh_job(food_agent, job)
+        if entry is not None:
+            entries.append(entry)
+            jobs.append(job)
+    if entries:
+        process_entries(food_agent, entries, workers, jobs)
+    work_queue.prune()
+    stats = work_queue.stats()
+    if stats["pending"] or stats["leased"]:
+        logging.info(f"条目队列: {stats}")
+
+
+def log_cache_stats(food_agent):
+    """记录本地查询缓存和LLM缓存的命中率，同时更新对应指标"""
+    for cache, stats in food_agent.cache_stats().items():
+        logging.info(
+            f"{cache}缓存命中率: {stats['hit_rate']:.1%} "
+            f"({stats['hits']}/{stats['hits'] + stats['misses']}), 条目 {stats['size']}"
+        )
+
+
+def main(food_agent=None, workers=ENTRY_WORKERS):
+    """一次完整轮询
+
+    food_agent: 进程内复用的FoodAgent，保留查询缓存、n-gram索引和SingleFlight；
+    为None时新建"""
+    food_agent = food_agent or FoodAgent()
+
+    food_agent.update_food_item()
+    entries = food_agent.notion.get_pending_entries()
+    if entries:
+        get_work_queue().enqueue(entries)
+    process_queue(food_agent, workers)
+    log_cache_stats(food_agent)
+
+
+def process_triggered(page_ids, food_agent):
+    """处理webhook通知的页面：主数据库条目直接处理，食物数据库页面触发食物更新"""
+    main_database_id = food_agent.notion.main_database_id.replace("-", "")
+    entries = []
+    food_changed = False
+    for page_id in page_ids:
+        page = food_agent.notion.get_page(page_id)
+        if not page:
+            continue
+        parent_id = page.get("parent", {}).get("database_id", "").replace("-", "")
+        if parent_id != main_database_id:
+            food_changed = True
+        elif is_pending(page):
+            entries.append(page)
+    if food_changed:
+        food_agent.update_food_item()
+    if entries:
+        get_work_queue().enqueue(entries)
+        process_queue(food_agent)
+    log_cache_stats(food_agent)
+
+
+def run_event_mode(port=METRICS_PORT):
+    """事件驱动模式: 收到webhook立即处理相关条目，并以较长间隔兜底轮询
+
+    没有设置WEBHOOK_SECRET时只监听本机，避免任何人都能触发全量处理"""
+    triggers = Queue()
+    host = "0.0.0.0" if WEBHOOK_SECRET else "127.0.0.1"
+    if not WEBHOOK_SECRET:
+        logging.warning("未设置WEBHOOK_SECRET，webhook只接受本机请求")
+    start_metrics_server(port, handler=make_trigger_handler(triggers), host=host)
+    logging.info(f"事件模式已启动: POST http://{host}:{port}/webhook")
+    # 整个进程共用一个FoodAgent，缓存和索引跨轮次保留
+    food_agent = FoodAgent()
+    last_poll = 0
     while True:
+        timeout = max(0, last_poll + FALLBACK_POLL_INTERVAL - time())
+        try:
+            page_ids = {triggers.get(timeout=timeout)}
+        except Empty:
+            page_ids = {ALL_PENDING}
+        # 短暂等待以合并同一批编辑产生的多个通知
+        sleep(TRIGGER_DEBOUNCE)
+        while not triggers.empty():
+            page_ids.add(triggers.get_nowait())
+        # 通知持续到达时也要按时兜底轮询
+        poll = ALL_PENDING in page_ids or time() - last_poll >= FALLBACK_POLL_INTERVAL
         try:
-            logging.info(time())
-            main()
+            if poll:
+                logging.info("兜底轮询/全量触发")
+                main(food_agent)
+            else:
+                logging.info(f"webhook触发: {page_ids}")
+                process_triggered(page_ids, food_agent)
         except Exception as e:
             logging.error(f"发生错误: {e}")
-
         finally:
-            sleep(10)
+            # 出错时也记录，避免持续出错时每秒重跑一次全量处理
+            if poll:
+                last_poll = time()
+
+
+if __name__ == "__main__":
+    if RUN_MODE == "event":
+        run_event_mode()
+    elif RUN_MODE == "async":
+        import asyncio
+        from async_agent import run_forever
+
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
+        asyncio.run(run_forever())
+    else:
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
+            logging.info(f"指标服务已启动: http://0.0.0.0:{METRICS_PORT}/metrics")
+        food_agent = FoodAgent()
+        while True:
+            try:
+                logging.info(time())
+                main(food_agent)
+            except Exception as e:
+                logging.error(f"发生错误: {e}")
+
+            finally:
+                sleep(10)
 
     # food_agent = FoodAgent()
     # all_entry_list = food_agent.notion.get_all_entries()
@@ -0,0 +1,332 @@
+import asyncio
+import logging
+import os
+import time
+
+from async_llm_query import AsyncLLMService
+from async_notion import AsyncNotion
+from database_update import FoodAgent
+from food_database import LocalFoodDatabase, collect_food_rows
+from llm_cache import normalize_key
+from metrics import ENTRIES_PROCESSED, PARSE_TOTAL, REFERENCE_LOOKUPS, STAGE_DURATION
+from notion import EntryUpdate, entry_description, entry_foods, notion_timestamp
+from nutrition_reference import open_reference
+from parse_input import llm_fallback_rate, parse_multiple_food, record_parse
+from single_flight import AsyncSingleFlight
+
+
+# 同时处理的条目数上限
+ASYNC_ENTRY_CONCURRENCY = int(os.getenv("ASYNC_ENTRY_CONCURRENCY", "8"))
+
+
+class AsyncFoodAgent(FoodAgent):
+    """FoodAgent的asyncio版本，在一个事件循环中并发处理条目、创建食物和同步
+
+    本地数据库操作与同步版本共用(lookup_local、lookup_parsed_local等)，涉及Notion和LLM的方法为协程。"""
+
+    def __init__(
+        self,
+        local_db=None,
+        notion=None,
+        llm_service=None,
+        concurrency=ASYNC_ENTRY_CONCURRENCY,
+    ):
+        self.local_db = local_db or LocalFoodDatabase()
+        self.notion = notion or AsyncNotion()
+        self.llm_service = llm_service or AsyncLLMService()
+        self.reference = open_reference()
+        self.entry_semaphore = asyncio.Semaphore(concurrency)
+        self.flights = AsyncSingleFlight()
+
+    async def aclose(self):
+        await asyncio.gather(self.notion.aclose(), self.llm_service.aclose())
+
+    async def add_to_db(self, food_item):
+        notion_id = None
+        try:
+            notion_id = await self.notion.create_food_item(food_item)
+        except Exception as e:
+            print(f"添加到Notion失败: {e}")
+        if notion_id:
+            food_item.notion_id = notion_id
+            self.local_db.add_food_item(food_item)
+        else:
+            print(f"添加到Notion失败: {food_item.name}")
+
+    async def lookup_reference(self, food_name, unit):
+        """见FoodAgent.lookup_reference"""
+        if self.reference is None:
+            return None
+        with STAGE_DURATION.time(stage="lookup"):
+            food_item = self.reference.lookup(food_name, unit)
+        REFERENCE_LOOKUPS.inc(result="hit" if food_item else "miss")
+        if food_item:
+            await self.add_to_db(food_item)
+        return food_item
+
+    async def parse_description(self, food_description):
+        """见FoodAgent.parse_description"""
+        with STAGE_DURATION.time(stage="parse"):
+            try:
+                food_items = parse_multiple_food(food_description)
+                PARSE_TOTAL.inc(source="parser")
+                return food_items
+            except:
+                record_parse("llm_fallback")
+                PARSE_TOTAL.inc(source="llm")
+            try:
+                return await self.llm_service.get_name_quantity_unit(food_description)
+            except:
+                return None
+
+    async def resolve_unknown_foods(self, foods):
+        """见FoodAgent.resolve_unknown_foods，同一事件循环中的并发请求共享一次查找"""
+        foods = {
+            normalize_key(food_name, unit): (food_name, unit)
+            for food_name, unit in foods
+        }
+        return await self.flights.do_many(
+            list(foods), lambda keys: self._resolve_foods([foods[key] for key in keys])
+        )
+
+    async def _resolve_foods(self, foods):
+        """见FoodAgent._resolve_foods，参考库查找和新食物写入并发进行"""
+        results = [
+            self.local_db.get_food_item(food_name, unit) for food_name, unit in foods
+        ]
+        missing = [i for i, food_item in enumerate(results) if food_item is None]
+        references = await asyncio.gather(
+            *(self.lookup_reference(*foods[i]) for i in missing)
+        )
+        pending = []
+        for i, food_item in zip(missing, references):
+            results[i] = food_item
+            if food_item is None:
+                pending.append(i)
+        if not pending:
+            return results
+        print(f"合并查询{len(pending)}种未知食物")
+        llm_food_result = await self.llm_service.get_food_nutrition(
+            [{"food_name": foods[i][0], "unit": foods[i][1]} for i in pending]
+        )
+        for i, food_item in zip(pending, llm_food_result):
+            results[i] = food_item
+        await asyncio.gather(
+            *(self.add_to_db(item) for item in llm_food_result if item is not None)
+        )
+        return results
+
+    async def prefetch_nutrition(self, food_descriptions):
+        """见FoodAgent.prefetch_nutrition"""
+        food_descriptions = list(dict.fromkeys(food_descriptions))
+        parsed = dict(
+            zip(
+                food_descriptions,
+                await asyncio.gather(
+                    *(self.parse_description(desc) for desc in food_descriptions)
+                ),
+            )
+        )
+        found, unknown = self.lookup_parsed_local(parsed)
+        if unknown:
+            resolved = await self.resolve_unknown_foods(unknown.values())
+            found.update((k, item) for k, item in resolved.items() if item is not None)
+        return parsed, found
+
+    async def process_food_description(
+        self, food_description, resolved=None, parsed=None
+    ):
+        """见FoodAgent.process_food_description，调用方负责先同步本地数据库"""
+        if parsed is not None and food_description in parsed:
+            food_items = parsed[food_description]
+        else:
+            food_items = await self.parse_description(food_description)
+        if food_items is None:
+            return [(food_description, 1, "个")], [None]
+        resolved = resolved or {}
+        quantities = []
+        food_results = []
+        not_in_local = []
+        for i, (food_name, quantity, unit) in enumerate(food_items):
+            quantities.append(quantity)
+            food_item = resolved.get(
+                normalize_key(food_name, unit)
+            ) or self.lookup_local(food_name, unit)
+            food_results.append(food_item)
+            if not food_item:
+                not_in_local.append((i, food_name, unit))
+        if not_in_local:
+            found = await self.resolve_unknown_foods(
+                [(food_name, unit) for _, food_name, unit in not_in_local]
+            )
+            for i, food_name, unit in not_in_local:
+                food_results[i] = found[normalize_key(food_name, unit)]
+        return quantities, food_results
+
+    async def sync_database(self, full=None):
+        """用异步客户端读取Notion，对账和写入与LocalFoodDatabase.sync_database相同"""
+        full, watermark = self.local_db.plan_sync(full)
+        with STAGE_DURATION.time(stage="sync"):
+            started_at = time.time()
+            start = time.perf_counter()
+            try:
+                if full:
+                    food_items = self.notion.iter_all_food_items()
+                else:
+                    food_items = self.notion.iter_food_items_edited_since(watermark)
+                remote_rows, new_watermark = collect_food_rows(
+                    [food_item async for food_item in food_items],
+                    None if full else watermark,
+                )
+            except Exception as e:
+                print(f"同步Notion数据库失败: {e}")
+                return False
+            fetch_time = time.perf_counter() - start
+            return self.local_db.apply_sync(
+                full, remote_rows, new_watermark, started_at, fetch_time
+            )
+
+    async def _entry_foods_from_notion(self, entry_id):
+        """本地没有记录时读取条目页面，食物从本地按ID取，不再逐个GET"""
+        page = await self.notion.get_page(entry_id)
+        if not page:
+            return None
+        try:
+            notion_ids, quantities = entry_foods(page)
+        except (KeyError, IndexError, ValueError) as e:
+            print(f"获取条目失败: {entry_id}, {e}")
+            return None
+        food_items = self.local_db.get_food_items_by_ids(notion_ids)
+        if food_items is None:
+            return None
+        self.local_db.record_entry(
+            entry_id, food_items, quantities, notion_timestamp(page.get("created_time"))
+        )
+        return food_items, quantities
+
+    async def _recompute_entry(self, entry_id):
+        entry_foods = self.local_db.get_entry_foods(entry_id)
+        if entry_foods is None:
+            entry_foods = await self._entry_foods_from_notion(entry_id)
+        if entry_foods is None:
+            return False
+        food_items, quantities = entry_foods
+        try:
+            updated = await self.notion.update_main_database(
+                entry_id, food_items, quantities
+            )
+        except Exception as e:
+            print(f"更新主数据库失败: {e}")
+            return False
+        if updated:
+            # 刷新本地镜像中的营养合计
+            self.local_db.record_entry(entry_id, food_items, quantities)
+        return updated
+
+    async def _update_one_food(self, food):
+        self.local_db.add_food_item(food)
+        print(f"更新食物: {food.name}")
+        entry_ids = self.local_db.get_entries_for_food(food.notion_id)
+        complete = True
+        if not self.local_db.entry_index_complete():
+            # 见FoodAgent.update_food_item
+            page = await self.notion.get_page(food.notion_id)
+            complete = page is not None
+            relations = (
+                (page or {}).get("properties", {}).get("关联", {}).get("relation", [])
+            )
+            entry_ids = list(
+                dict.fromkeys(entry_ids + [relation["id"] for relation in relations])
+            )
+        results = await asyncio.gather(
+            *(self._recompute_entry(entry_id) for entry_id in entry_ids)
+        )
+        if complete and all(results):
+            await self.notion.fix_updated_status(food)
+
+    async def update_food_item(self):
+        """见FoodAgent.update_food_item，各食物和关联条目并发更新"""
+        to_update_foods = await self.notion.get_update_food()
+        if not to_update_foods:
+            return
+        print(f"需要更新的食物: {to_update_foods}")
+        await asyncio.gather(*(self._update_one_food(food) for food in to_update_foods))
+
+    async def process_entry(self, entry, resolved=None, parsed=None):
+        """见app.process_entry"""
+        async with self.entry_semaphore:
+            start_time = time.time()
+            entry_id = entry["id"]
+            try:
+                quantities, food_items = await self.process_food_description(
+                    entry_description(entry), resolved=resolved, parsed=parsed
+                )
+                await self.notion.ensure_food_ids(food_items)
+                update = (
+                    EntryUpdate()
+                    .relations(food_items)
+                    .totals(food_items, quantities)
+                    .status("已完成")
+                )
+            except Exception as e:
+                logging.error(f"处理条目 {entry_id} 失败: {e}")
+                update = EntryUpdate().status("出错")
+            success = update.properties["状态"]["select"]["name"] == "已完成"
+            update.elapsed(time.time() - start_time)
+            page = await self.notion.commit_entry(entry_id, update)
+            if page is None and success:
+                success = False
+                await self.notion.commit_entry(
+                    entry_id,
+                    EntryUpdate().status("出错").elapsed(time.time() - start_time),
+                )
+            if success:
+                self.local_db.record_entry(
+                    entry_id,
+                    food_items,
+                    quantities,
+                    notion_timestamp(entry.get("created_time")),
+                )
+            ENTRIES_PROCESSED.inc(status="success" if success else "error")
+            return success
+
+    async def process_entries(self, entries):
+        descriptions = []
+        for entry in entries:
+            try:
+                descriptions.append(entry_description(entry))
+            except (KeyError, IndexError):
+                continue
+        parsed, resolved = await self.prefetch_nutrition(descriptions)
+        results = await asyncio.gather(
+            *(self.process_entry(entry, resolved, parsed) for entry in entries)
+        )
+        logging.info(f"本轮处理 {len(results)} 个条目, 成功 {sum(results)} 个")
+        logging.info(f"解析LLM回退率: {llm_fallback_rate():.1%}")
+        return results
+
+    async def run_once(self):
+        """同步本地数据库、拉取待处理条目和更新异常食物同时进行，然后并发处理条目"""
+        _, entries, _ = await asyncio.gather(
+            self.sync_database(),
+            self.notion.get_pending_entries(),
+            self.update_food_item(),
+        )
+        if entries:
+            await self.process_entries(entries)
+
+
+async def run_forever(interval=10):
+    """事件循环中的轮询模式，共享一个AsyncFoodAgent及其连接池"""
+    food_agent = AsyncFoodAgent()
+    try:
+        while True:
+            try:
+                await food_agent.run_once()
+                for cache, stats in food_agent.cache_stats().items():
+                    logging.info(f"{cache}缓存命中率: {stats['hit_rate']:.1%}")
+            except Exception as e:
+                logging.error(f"发生错误: {e}")
+            await asyncio.sleep(interval)
+    finally:
+        await food_agent.aclose()
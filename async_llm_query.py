@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+import httpx
+from llm_query import (
+    LLM_CONCURRENCY,
+    LLM_CONNECT_TIMEOUT,
+    LLM_DEADLINE,
+    LLM_MAX_RETRIES,
+    LLM_MAX_TOKENS,
+    LLM_READ_TIMEOUT,
+    PROMPT_STYLE,
+    LLMService,
+    align_nutrition_result,
+    chunk_food_items,
+    llm_retry_delay,
+    name_quantity_unit_prompt,
+    nutrition_prompt,
+    parse_name_quantity_unit_result,
+    record_usage,
+    response_text,
+)
+from metrics import LLM_FOOD_ITEMS, LLM_REQUESTS, STAGE_DURATION
+from rate_limiter import backoff_delay
+
+
+class AsyncLLMService(LLMService):
+    """LLMService的asyncio版本，缓存、提示词和结果解析与同步版本共用，
+    查询方法为协程"""
+
+    def __init__(
+        self,
+        cache=None,
+        client=None,
+        concurrency=LLM_CONCURRENCY,
+        max_tokens=LLM_MAX_TOKENS,
+        prompt_style=PROMPT_STYLE,
+    ):
+        super().__init__(cache, max_tokens=max_tokens, prompt_style=prompt_style)
+        # requests会忽略值为None的头(未配置LLM_API_KEY时)，httpx不会
+        self.headers = {k: v for k, v in self.headers.items() if v is not None}
+        self.client = client or httpx.AsyncClient(
+            timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=concurrency),
+        )
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def query_llm(self, prompt, temperature=0.1, method="query"):
+        """重试和时限规则与LLMService.query_llm相同"""
+        payload = self._payload(prompt, temperature)
+        started = time.monotonic()
+        deadline = started + LLM_DEADLINE
+        with STAGE_DURATION.time(stage="llm"):
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                last_attempt = attempt == LLM_MAX_RETRIES
+                remaining = max(1.0, deadline - time.monotonic())
+                try:
+                    async with self.semaphore:
+                        response = await asyncio.wait_for(
+                            self.client.post(
+                                self.llm_url, headers=self.headers, json=payload
+                            ),
+                            remaining,
+                        )
+                except (httpx.TransportError, asyncio.TimeoutError) as e:
+                    LLM_REQUESTS.inc(method=method, status="error")
+                    delay = backoff_delay(attempt)
+                    if last_attempt or time.monotonic() + delay >= deadline:
+                        raise
+                    print(f"LLM请求异常，准备重试: {e!r}")
+                    await asyncio.sleep(delay)
+                    continue
+                LLM_REQUESTS.inc(method=method, status=response.status_code)
+                delay = llm_retry_delay(response, attempt)
+                if (
+                    delay is None
+                    or last_attempt
+                    or time.monotonic() + delay >= deadline
+                ):
+                    break
+                print(f"LLM API返回{response.status_code}，{delay:.1f}秒后重试")
+                await asyncio.sleep(delay)
+        if response.status_code == 200:
+            data = response.json()
+            record_usage(data, method, time.monotonic() - started)
+            return response_text(data)
+        print(f"LLM API调用失败: {response.status_code}")
+        return None
+
+    async def get_food_nutrition(self, food_items):
+        """见LLMService.get_food_nutrition"""
+        results, misses = self._cached_nutrition(food_items)
+        if not misses:
+            return results
+        llm_items = await self._query_food_nutrition([food for _, _, food in misses])
+        return self._merge_nutrition(results, misses, llm_items)
+
+    async def _query_food_nutrition(self, food_items):
+        """见LLMService._query_food_nutrition"""
+        chunk_results = await asyncio.gather(
+            *(
+                self._query_nutrition_chunk(chunk)
+                for chunk in chunk_food_items(food_items, self.max_tokens)
+            )
+        )
+        return [food_item for chunk in chunk_results for food_item in chunk]
+
+    async def _query_nutrition_chunk(self, chunk):
+        LLM_FOOD_ITEMS.inc(len(chunk))
+        try:
+            result_text = await self.query_llm(
+                nutrition_prompt(chunk, self.prompt_style), method="nutrition"
+            )
+        except (httpx.HTTPError, asyncio.TimeoutError) as e:
+            print(f"LLM请求失败: {e!r}")
+            return [None] * len(chunk)
+        return align_nutrition_result(chunk, result_text, self.prompt_style)
+
+    async def get_name_quantity_unit(self, food_description):
+        """见LLMService.get_name_quantity_unit"""
+        cached = self._cached_parse(food_description)
+        if cached:
+            return cached
+        food_items = await self._query_name_quantity_unit(food_description)
+        self._store_parse(food_description, food_items)
+        return food_items
+
+    async def _query_name_quantity_unit(self, food_description):
+        result_text = await self.query_llm(
+            name_quantity_unit_prompt(food_description, self.prompt_style),
+            method="parse",
+        )
+        return parse_name_quantity_unit_result(result_text, self.prompt_style)
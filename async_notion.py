@@ -0,0 +1,223 @@
+import asyncio
+import os
+from contextlib import nullcontext
+
+import httpx
+from FoodItem import FoodItem
+from metrics import NOTION_REQUESTS, STAGE_DURATION
+from notion import (
+    ALL_ENTRIES_QUERY,
+    ALL_FOOD_QUERY,
+    NOTION_API_URL,
+    NOTION_CONNECT_TIMEOUT,
+    NOTION_FOOD_DATABASE_ID,
+    NOTION_MAIN_DATABASE_ID,
+    NOTION_MAX_RETRIES,
+    NOTION_POOL_SIZE,
+    NOTION_READ_TIMEOUT,
+    PENDING_ENTRIES_QUERY,
+    UPDATE_FOOD_QUERY,
+    EntryUpdate,
+    Notion,
+    edited_since_query,
+    food_lookup_query,
+    is_idempotent_request,
+    is_read_request,
+    new_food_page,
+    notion_headers,
+    rate_limiter,
+    retry_delay,
+)
+from rate_limiter import backoff_delay
+
+
+# 同时在途的Notion请求数上限
+NOTION_ASYNC_CONCURRENCY = int(
+    os.getenv("NOTION_ASYNC_CONCURRENCY", str(NOTION_POOL_SIZE))
+)
+
+
+class AsyncNotion:
+    """Notion客户端的asyncio版本，方法与Notion同名，网络I/O方法为协程
+
+    与同步客户端共享同一个rate_limiter，同一进程内的线程和协程合计不超过
+    NOTION_RATE_LIMIT；信号量限制同时在途的请求数。"""
+
+    parse_food_item = staticmethod(Notion.parse_food_item)
+
+    def __init__(self, client=None, concurrency=NOTION_ASYNC_CONCURRENCY):
+        self.main_database_id = NOTION_MAIN_DATABASE_ID
+        self.food_database_id = NOTION_FOOD_DATABASE_ID
+        self.client = client or httpx.AsyncClient(
+            headers=notion_headers,
+            timeout=httpx.Timeout(NOTION_READ_TIMEOUT, connect=NOTION_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=NOTION_POOL_SIZE,
+                max_keepalive_connections=NOTION_POOL_SIZE,
+            ),
+        )
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _request(self, method, url, idempotent=None, **kwargs):
+        """重试和限流规则与Notion._request相同"""
+        if is_read_request(method, url):
+            stage = nullcontext()
+        else:
+            stage = STAGE_DURATION.time(stage="notion_write")
+        with stage:
+            return await self._send(method, url, idempotent, **kwargs)
+
+    async def _send(self, method, url, idempotent, **kwargs):
+        if idempotent is None:
+            idempotent = is_idempotent_request(method, url)
+        for attempt in range(NOTION_MAX_RETRIES + 1):
+            last_attempt = attempt == NOTION_MAX_RETRIES
+            await rate_limiter.acquire_async()
+            try:
+                async with self.semaphore:
+                    response = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                NOTION_REQUESTS.inc(method=method, status="error")
+                if not idempotent or last_attempt:
+                    raise
+                print(f"Notion请求异常，准备重试: {e}")
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            NOTION_REQUESTS.inc(method=method, status=response.status_code)
+            delay = retry_delay(response, idempotent, attempt)
+            if delay is None or last_attempt:
+                return response
+            await asyncio.sleep(delay)
+        return response
+
+    async def query_database(self, database_id, payload=None, page_size=100):
+        """按游标分页查询数据库，逐条产出页面对象
+
+        请求失败时抛出httpx.HTTPStatusError"""
+        url = f"{NOTION_API_URL}/databases/{database_id}/query"
+        body = dict(payload or {})
+        body["page_size"] = page_size
+        while True:
+            response = await self._request("POST", url, json=body)
+            if response.status_code != 200:
+                print(f"查询Notion数据库失败: {response.status_code}")
+                print(response.text)
+                response.raise_for_status()
+            data = response.json()
+            for result in data["results"]:
+                yield result
+            if not data.get("has_more") or not data.get("next_cursor"):
+                return
+            body["start_cursor"] = data["next_cursor"]
+
+    async def iter_food_items(self, payload=None):
+        async for result in self.query_database(self.food_database_id, payload):
+            yield self.parse_food_item(result)
+
+    def iter_all_entries(self):
+        return self.query_database(self.main_database_id, ALL_ENTRIES_QUERY)
+
+    def iter_pending_entries(self):
+        return self.query_database(self.main_database_id, PENDING_ENTRIES_QUERY)
+
+    def iter_all_food_items(self):
+        return self.iter_food_items(ALL_FOOD_QUERY)
+
+    def iter_update_food(self):
+        return self.iter_food_items(UPDATE_FOOD_QUERY)
+
+    def iter_food_items_edited_since(self, last_edited_time):
+        return self.iter_food_items(edited_since_query(last_edited_time))
+
+    async def get_pending_entries(self):
+        try:
+            return [entry async for entry in self.iter_pending_entries()]
+        except httpx.HTTPError as e:
+            print(f"获取Notion条目失败: {e}")
+            return None
+
+    async def get_update_food(self):
+        try:
+            return [food async for food in self.iter_update_food()]
+        except httpx.HTTPError as e:
+            print(f"获取食物条目失败: {e}")
+            return []
+
+    async def get_page(self, page_id):
+        response = await self._request("GET", f"{NOTION_API_URL}/pages/{page_id}")
+        if response.status_code == 200:
+            return response.json()
+        print(f"获取页面失败: {response.status_code}")
+        return None
+
+    async def commit_entry(self, entry_id, update: EntryUpdate):
+        """见Notion.commit_entry"""
+        url = f"{NOTION_API_URL}/pages/{entry_id}"
+        response = await self._request("PATCH", url, json=update.payload())
+        if response.status_code == 200:
+            return response.json()
+        print(f"更新Notion条目失败: {response.status_code}")
+        print(response.text)
+        return None
+
+    async def update_main_database(self, entry_id, food_items=[], quantities=[]):
+        update = EntryUpdate().totals(food_items, quantities).status("已完成")
+        if await self.commit_entry(entry_id, update) is not None:
+            return True
+        await self.commit_entry(entry_id, EntryUpdate().status("出错"))
+        return False
+
+    async def fix_updated_status(self, food_item: FoodItem):
+        url = f"{NOTION_API_URL}/pages/{food_item.notion_id}"
+        payload = {"properties": {"状态": {"select": {"name": "正常"}}}}
+        response = await self._request("PATCH", url, json=payload)
+        if response.status_code == 200:
+            return True
+        print(f"修复食物条目状态失败: {response.status_code}")
+        return False
+
+    async def query_food_item(self, food_name, unit, calories=None):
+        url = f"{NOTION_API_URL}/databases/{self.food_database_id}/query"
+        payload = food_lookup_query(food_name, unit, calories)
+        response = await self._request("POST", url, json=payload)
+        if response.status_code == 200:
+            results = response.json()["results"]
+            return results[0] if results else None
+        return None
+
+    async def create_food_item(self, food_item: FoodItem):
+        """在Notion数据库中创建食物条目，已存在时返回已有页面的ID"""
+        existing = await self.query_food_item(
+            food_item.name, food_item.unit, food_item.calories
+        )
+        if existing:
+            print(f"食物条目已存在: {food_item.name}")
+            return existing["id"]
+        url = f"{NOTION_API_URL}/pages"
+        payload = new_food_page(self.food_database_id, food_item)
+        response = await self._request("POST", url, json=payload)
+        if response.status_code == 200:
+            print(f"创建食物条目成功: {food_item.name}, {response.json().get('id')}")
+            return response.json()["id"]
+        print(f"创建食物条目失败: {response.status_code}")
+        print(response.text)
+        return None
+
+    async def ensure_food_ids(self, food_items):
+        """并发为还没有notion_id的食物创建Notion页面"""
+        missing = [food_item for food_item in food_items if not food_item.notion_id]
+        notion_ids = await asyncio.gather(
+            *(self.create_food_item(food_item) for food_item in missing)
+        )
+        for food_item, notion_id in zip(missing, notion_ids):
+            food_item.notion_id = notion_id
+        return food_items
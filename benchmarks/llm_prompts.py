@@ -0,0 +1,127 @@
+"""比较compact和legacy两种提示词的token用量与延迟
+
+用法:
+    python benchmarks/llm_prompts.py                  # 每种格式各查询3轮
+    python benchmarks/llm_prompts.py --rounds 5 --chunk 20
+
+会真实调用LLM_API_URL(需要LLM_API_KEY)，不读写LLM缓存。token数取自响应的usage字段。
+"""
+
+import argparse
+import os
+import sys
+import time
+
+os.environ["LLM_CACHE_PATH"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_query import LLMService, chunk_food_items  # noqa: E402
+from metrics import LLM_TOKENS  # noqa: E402
+
+
+FOODS = [
+    ("米饭", "碗"),
+    ("鸡蛋", "个"),
+    ("牛奶", "毫升"),
+    ("全麦面包", "片"),
+    ("红烧肉", "克"),
+    ("苹果", "个"),
+    ("拿铁咖啡", "杯"),
+    ("去皮鸡腿", "个"),
+    ("卤肉饭", "碗"),
+    ("燕麦片", "克"),
+    ("香蕉", "根"),
+    ("酸奶", "盒"),
+    ("炒青菜", "盘"),
+    ("水饺", "个"),
+    ("豆浆", "杯"),
+    ("三文鱼", "克"),
+    ("巨无霸", "个"),
+    ("麻辣烫", "份"),
+    ("橙汁", "毫升"),
+    ("咖啡:300卡", "杯"),
+]
+DESCRIPTIONS = [
+    "两碗米饭，一个去皮的鸡腿",
+    "早餐吃了一杯豆浆和两根油条",
+    "巨无霸加中薯条",
+]
+
+
+def tokens(method):
+    return (
+        LLM_TOKENS.get(method=method, type="input"),
+        LLM_TOKENS.get(method=method, type="output"),
+    )
+
+
+def run_style(style, rounds, chunk):
+    service = LLMService(cache=None, prompt_style=style)
+    food_items = [{"food_name": name, "unit": unit} for name, unit in FOODS]
+    latencies = []
+    parsed = 0
+    before = tokens("nutrition")
+    for _ in range(rounds):
+        for batch in chunk_food_items(food_items, service.max_tokens, chunk):
+            start = time.perf_counter()
+            results = service._query_nutrition_chunk(batch)
+            latencies.append(time.perf_counter() - start)
+            parsed += sum(1 for item in results if item is not None)
+    after = tokens("nutrition")
+    items = rounds * len(food_items)
+
+    parse_before = tokens("parse")
+    parse_latencies = []
+    for _ in range(rounds):
+        for description in DESCRIPTIONS:
+            start = time.perf_counter()
+            service._query_name_quantity_unit(description)
+            parse_latencies.append(time.perf_counter() - start)
+    parse_after = tokens("parse")
+    descriptions = rounds * len(DESCRIPTIONS)
+
+    latencies.sort()
+    return {
+        "style": style,
+        "calls": len(latencies),
+        "parsed": f"{parsed}/{items}",
+        "in/item": (after[0] - before[0]) / items,
+        "out/item": (after[1] - before[1]) / items,
+        "p50_s": latencies[len(latencies) // 2],
+        "max_s": latencies[-1],
+        "parse_in": (parse_after[0] - parse_before[0]) / descriptions,
+        "parse_out": (parse_after[1] - parse_before[1]) / descriptions,
+        "parse_p50_s": sorted(parse_latencies)[len(parse_latencies) // 2],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=3, help="每种格式重复的轮数")
+    parser.add_argument("--chunk", type=int, default=5, help="每次营养查询包含的食物数")
+    args = parser.parse_args(argv)
+    if not os.getenv("LLM_API_KEY") and not os.getenv("LLM_API_URL"):
+        print("未配置LLM_API_KEY")
+        return 1
+
+    results = [
+        run_style(style, args.rounds, args.chunk) for style in ("legacy", "compact")
+    ]
+    columns = list(results[0])
+    print("".join(f"{column:>12}" for column in columns))
+    for result in results:
+        print(
+            "".join(
+                f"{value:>12.2f}" if isinstance(value, float) else f"{value:>12}"
+                for value in result.values()
+            )
+        )
+    legacy, compact = results
+    for key in ("in/item", "out/item", "p50_s"):
+        if legacy[key]:
+            print(f"{key}: {(compact[key] - legacy[key]) / legacy[key]:+.1%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
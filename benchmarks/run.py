@@ -0,0 +1,249 @@
+"""离线微基准: 解析、本地查询和同步对账热点路径
+
+用法:
+    python benchmarks/run.py                       # 运行并与基线比较
+    python benchmarks/run.py --save-baseline       # 运行并保存为基线
+    python benchmarks/run.py --sizes 1000 --threshold 0.3
+
+基线保存在benchmarks/baseline.json，ops/sec比基线下降超过threshold时
+标记为回归并以非零状态退出；没有基线文件时也以非零状态退出。
+仓库中的基线由默认参数生成，与机器相关，换机器比较前先在基线提交上重新生成。
+全部使用本地临时数据库和假Notion客户端，不访问网络。
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FoodItem import FoodItem  # noqa: E402
+from food_database import LocalFoodDatabase, diff_food_rows, food_row  # noqa: E402
+from parse_input import parse_multiple_food  # noqa: E402
+
+
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+NAME_CHARS = (
+    "米饭面条鸡肉牛羊猪鱼虾蛋奶豆腐菜瓜果汤粥饼包子饺馄饨炒煎烤蒸卤红烧麻辣酸甜"
+)
+UNITS = ["个", "碗", "克", "份", "杯", "片", "块", "根", "盘", "包"]
+NUMBERS = ["一", "两", "三", "十二", "二十五", "半", "1", "2", "1.5", "200", "1/2"]
+
+
+class FakeNotion:
+    """只提供sync_database需要的迭代接口"""
+
+    def __init__(self, food_items):
+        self.food_items = food_items
+
+    def iter_all_food_items(self):
+        return iter(self.food_items)
+
+    def iter_food_items_edited_since(self, last_edited_time):
+        return iter(())
+
+
+def make_food_items(count, seed=0):
+    rng = random.Random(seed)
+    food_items = []
+    for i in range(count):
+        name = "".join(rng.choice(NAME_CHARS) for _ in range(rng.randint(2, 5)))
+        food_item = FoodItem(
+            name=f"{name}{i}",
+            calories=round(rng.uniform(0.5, 800), 2),
+            unit=rng.choice(UNITS),
+            protein=round(rng.uniform(0, 40), 2),
+            fat=round(rng.uniform(0, 40), 2),
+            carbs=round(rng.uniform(0, 90), 2),
+            grams=round(rng.uniform(1, 500), 1),
+        )
+        food_item.notion_id = f"page-{i}"
+        food_item.last_edited_time = "2024-01-01T00:00:00.000Z"
+        food_items.append(food_item)
+    return food_items
+
+
+def make_descriptions(count, seed=0):
+    rng = random.Random(seed)
+    descriptions = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(1, 4)):
+            name = "".join(rng.choice(NAME_CHARS) for _ in range(rng.randint(2, 4)))
+            parts.append(f"{rng.choice(NUMBERS)}{rng.choice(UNITS)}{name}")
+        descriptions.append("，".join(parts))
+    return descriptions
+
+
+def make_database(directory, food_items):
+    db = LocalFoodDatabase(os.path.join(directory, "food.db"))
+    db._apply_food_diff(
+        {
+            "added": [(item.notion_id, food_row(item)) for item in food_items],
+            "modified": [],
+            "removed": [],
+        }
+    )
+    return db
+
+
+def measure(func, min_time=1.0, min_runs=5, max_runs=100000):
+    """重复运行func直到达到min_time秒，返回每次耗时(秒)列表"""
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < max_runs and (
+        len(samples) < min_runs or time.perf_counter() < deadline
+    ):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1e6
+
+    return {
+        "runs": len(samples),
+        "ops_per_sec": len(samples) / sum(samples),
+        "p50_us": percentile(0.50),
+        "p95_us": percentile(0.95),
+        "p99_us": percentile(0.99),
+    }
+
+
+def run_benchmarks(sizes, min_time):
+    results = {}
+    rng = random.Random(1)
+
+    descriptions = make_descriptions(1000)
+    cycle = itertools.cycle(descriptions)
+    results["parse_multiple_food"] = summarize(
+        measure(lambda: parse_multiple_food(next(cycle)), min_time)
+    )
+
+    for size in sizes:
+        food_items = make_food_items(size)
+        directory = tempfile.mkdtemp(prefix="food_bench_")
+        db = make_database(directory, food_items)
+        hot = [rng.choice(food_items) for _ in range(200)]
+
+        def lookup_hot():
+            item = rng.choice(hot)
+            db.get_food_item(item.name, item.unit)
+
+        def lookup_cold():
+            item = rng.choice(food_items)
+            db.cache.clear()
+            db.get_food_item(item.name, item.unit)
+
+        results[f"get_food_item_hot[{size}]"] = summarize(measure(lookup_hot, min_time))
+        results[f"get_food_item_cold[{size}]"] = summarize(
+            measure(lookup_cold, min_time)
+        )
+        results[f"get_all_food_items[{size}]"] = summarize(
+            measure(db.get_all_food_items, min_time, min_runs=3)
+        )
+
+        # 远端相对本地有0.5%的行被修改、0.5%的行被删除
+        remote = {item.notion_id: food_row(item) for item in food_items}
+        local = dict(remote)
+        changed = rng.sample(list(remote), max(1, size // 100))
+        for notion_id in changed[: len(changed) // 2]:
+            row = list(remote[notion_id])
+            row[1] += 1
+            remote[notion_id] = tuple(row)
+        for notion_id in changed[len(changed) // 2 :]:
+            del remote[notion_id]
+        results[f"diff_food_rows[{size}]"] = summarize(
+            measure(lambda: diff_food_rows(local, remote), min_time, min_runs=3)
+        )
+
+        notion = FakeNotion(food_items)
+        results[f"sync_database_noop[{size}]"] = summarize(
+            measure(lambda: db.sync_database(notion, full=True), min_time, min_runs=3)
+        )
+        db.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """return: [(名称, 基线ops/sec, 当前ops/sec, 变化比例)]中的回归项"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["ops_per_sec"]
+        after = result["ops_per_sec"]
+        change = (after - before) / before
+        if change < -threshold:
+            regressions.append((name, before, after, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000,100000",
+        help="合成食物表的行数，逗号分隔",
+    )
+    parser.add_argument("--min-time", type=float, default=1.0, help="每项最少运行秒数")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基线文件路径")
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="把本次结果保存为基线"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="ops/sec下降超过该比例视为回归"
+    )
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = run_benchmarks(sizes, args.min_time)
+
+    print(
+        f"{'benchmark':<34}{'ops/sec':>12}{'p50(us)':>12}{'p95(us)':>12}{'p99(us)':>12}"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:<34}{result['ops_per_sec']:>12.1f}{result['p50_us']:>12.1f}"
+            f"{result['p95_us']:>12.1f}{result['p99_us']:>12.1f}"
+        )
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"基线已保存: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"没有基线文件: {args.baseline}")
+        print("先运行 python benchmarks/run.py --save-baseline 生成基线")
+        return 2
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for name, before, after, change in regressions:
+        print(f"回归: {name} {before:.1f} -> {after:.1f} ops/sec ({change:+.1%})")
+    if not regressions:
+        print(f"与基线相比没有超过{args.threshold:.0%}的回归")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,26 @@
+import os
+
 from food_database import LocalFoodDatabase
+from llm_cache import normalize_key
 from llm_query import LLMService
-from parse_input import parse_multiple_food
-from notion import Notion
+from metrics import (
+    CACHE_HIT_RATE,
+    CACHE_SIZE,
+    LOCAL_LOOKUPS,
+    PARSE_TOTAL,
+    REFERENCE_LOOKUPS,
+    STAGE_DURATION,
+)
+from nutrition_reference import open_reference
+from parse_input import parse_multiple_food, record_parse
+from notion import Notion, entry_foods, notion_timestamp
+from single_flight import SingleFlight
+
+
+# 本地精确匹配失败时接受相似名称的最低相似度，0表示关闭
+FUZZY_MATCH_THRESHOLD = float(os.getenv("FUZZY_MATCH_THRESHOLD", "0.85"))
+# 相似名称还需字符互相覆盖的最低比例，避免"炒米饭"匹配到"米饭"
+FUZZY_MATCH_COVERAGE = float(os.getenv("FUZZY_MATCH_COVERAGE", "0.9"))
 
 
 class FoodAgent:
@@ -9,9 +28,12 @@ class FoodAgent:
         self.local_db = LocalFoodDatabase()
         self.notion = Notion()
         self.llm_service = LLMService()
-        self.local_db.remove_duplicate_food_items()
+        self.reference = open_reference()
+        # 按normalize_key(名称, 单位)合并对同一未知食物的并发查询和创建
+        self.flights = SingleFlight()
 
     def add_to_db(self, food_item):
+        notion_id = None
         try:
             notion_id = self.notion.create_food_item(food_item)
         except Exception as e:
@@ -24,53 +46,221 @@ class FoodAgent:
         else:
             print(f"添加到Notion失败: {food_item.name}")
 
-    def process_food_description(self, food_description):
+    def cache_stats(self):
+        """本地查询缓存和LLM缓存的命中统计，同时更新CACHE_HIT_RATE和CACHE_SIZE
+
+        return: {"local": {...}, "llm": {...}}，未启用LLM缓存时没有llm"""
+        stats = {"local": self.local_db.cache_stats()}
+        if self.llm_service.cache:
+            stats["llm"] = self.llm_service.cache.stats()
+        for cache, values in stats.items():
+            CACHE_HIT_RATE.set(values["hit_rate"], cache=cache)
+            CACHE_SIZE.set(values["size"], cache=cache)
+        return stats
+
+    def lookup_local(self, food_name, unit):
+        """先精确匹配，再按FUZZY_MATCH_THRESHOLD和FUZZY_MATCH_COVERAGE接受同单位的相似名称
+
+        return: FoodItem or None"""
+        with STAGE_DURATION.time(stage="lookup"):
+            food_item = self.local_db.get_food_item(food_name, unit)
+            if food_item is None and FUZZY_MATCH_THRESHOLD > 0:
+                food_item = self.local_db.find_close_match(
+                    food_name, unit, FUZZY_MATCH_THRESHOLD, FUZZY_MATCH_COVERAGE
+                )
+        LOCAL_LOOKUPS.inc(result="hit" if food_item else "miss")
+        return food_item
+
+    def lookup_reference(self, food_name, unit):
+        """在营养参考库中查找，命中时写入Notion和本地库
+
+        return: FoodItem or None"""
+        if self.reference is None:
+            return None
+        with STAGE_DURATION.time(stage="lookup"):
+            food_item = self.reference.lookup(food_name, unit)
+        REFERENCE_LOOKUPS.inc(result="hit" if food_item else "miss")
+        if food_item:
+            print(f"在营养参考库中找到食物: {food_name}")
+            self.add_to_db(food_item)
+        return food_item
+
+    def parse_description(self, food_description):
+        """规则解析失败时回退到LLM
+
+        return: [(食物名称, 数量, 单位), ...] or None"""
+        with STAGE_DURATION.time(stage="parse"):
+            try:
+                food_items = parse_multiple_food(food_description)
+                PARSE_TOTAL.inc(source="parser")
+                return food_items
+            except:
+                record_parse("llm_fallback")
+                PARSE_TOTAL.inc(source="llm")
+            try:
+                return self.llm_service.get_name_quantity_unit(food_description)
+            except:
+                return None
+
+    def resolve_unknown_foods(self, foods):
+        """查找本地未命中的食物并写入Notion和本地库
+
+        同一(名称, 单位)正在被其他线程查找时等待其结果，不重复请求LLM和创建Notion页面。
+
+        foods: [(名称, 单位), ...]
+        return: {normalize_key(名称, 单位): FoodItem or None}"""
+        foods = {
+            normalize_key(food_name, unit): (food_name, unit)
+            for food_name, unit in foods
+        }
+        return self.flights.do_many(
+            list(foods), lambda keys: self._resolve_foods([foods[key] for key in keys])
+        )
+
+    def _resolve_foods(self, foods):
+        """依次尝试本地库、营养参考库和LLM
+
+        return: 与foods一一对应的[FoodItem or None]"""
+        results = []
+        pending = []
+        for i, (food_name, unit) in enumerate(foods):
+            # 上一次对同一食物的查找可能刚刚写入本地
+            food_item = self.local_db.get_food_item(
+                food_name, unit
+            ) or self.lookup_reference(food_name, unit)
+            results.append(food_item)
+            if food_item is None:
+                pending.append(i)
+        if not pending:
+            return results
+        print(f"合并查询{len(pending)}种未知食物")
+        llm_food_result = self.llm_service.get_food_nutrition(
+            [{"food_name": foods[i][0], "unit": foods[i][1]} for i in pending]
+        )
+        for i, food_item in zip(pending, llm_food_result):
+            if food_item is None:
+                continue
+            print(f"写入本地数据库: {food_item.name, food_item.unit}")
+            self.add_to_db(food_item)
+            results[i] = food_item
+        return results
+
+    def prefetch_nutrition(self, food_descriptions):
+        """合并多个条目中本地未命中的食物，去重后一次查找并写入数据库
+
+        LLMService按输出预算分段并行请求，查询失败的食物留给各条目单独查询。
+
+        return: (parsed, resolved)，供process_food_description使用，不再重复解析
+            parsed: {食物描述: parse_description的结果}
+            resolved: {normalize_key(名称, 单位): FoodItem}，包括本地命中的食物，
+                条目处理时不再重复查询本地库"""
+        parsed = {
+            food_description: self.parse_description(food_description)
+            for food_description in dict.fromkeys(food_descriptions)
+        }
+        found, unknown = self.lookup_parsed_local(parsed)
+        if unknown:
+            resolved = self.resolve_unknown_foods(unknown.values())
+            found.update((k, item) for k, item in resolved.items() if item is not None)
+        return parsed, found
+
+    def lookup_parsed_local(self, parsed):
+        """在本地库中查找解析结果中的食物，每个(名称, 单位)只查一次
+
+        return: (found, unknown)
+            found: {normalize_key(名称, 单位): FoodItem}
+            unknown: {normalize_key(名称, 单位): (名称, 单位)}"""
+        found = {}
+        unknown = {}
+        for food_items in parsed.values():
+            for food_name, _, unit in food_items or []:
+                key = normalize_key(food_name, unit)
+                if key in found or key in unknown:
+                    continue
+                food_item = self.lookup_local(food_name, unit)
+                if food_item:
+                    found[key] = food_item
+                else:
+                    unknown[key] = (food_name, unit)
+        return found, unknown
+
+    def process_food_description(
+        self, food_description, sync=True, resolved=None, parsed=None
+    ):
         """处理食物描述，返回匹配或新创建的食物项目
 
+        sync: 是否先同步本地数据库；批量并发处理时由调用方每轮同步一次
+        resolved, parsed: prefetch_nutrition的结果，已解析的描述不再重复解析，
+            命中的食物不再单独请求LLM
         returns: List[(quantity, FoodItem),...]
         """
-        try:
-            food_items = parse_multiple_food(food_description)
-        except:
-            try:
-                food_items = self.llm_service.get_name_quantity_unit(food_description)
-            except:
-                return [(food_description, 1, "个")], [None]
+        if parsed is not None and food_description in parsed:
+            food_items = parsed[food_description]
+        else:
+            food_items = self.parse_description(food_description)
+        if food_items is None:
+            return [(food_description, 1, "个")], [None]
+        resolved = resolved or {}
         print(f"解析食物描述: {food_items}")
         food_results = []
         quantities = []
         not_in_local = []
 
-        self.local_db.sync_database()
+        if sync:
+            self.local_db.sync_database(self.notion)
         for i, (food_name, quantity, unit) in enumerate(food_items):
             # 2. 在本地数据库中查找
 
             quantities.append(quantity)
-            food_item = self.local_db.get_food_item(food_name, unit)
+            if normalize_key(food_name, unit) in resolved:
+                print(f"使用合并查询结果: {food_name}")
+                food_results.append((i, resolved[normalize_key(food_name, unit)]))
+                continue
+            food_item = self.lookup_local(food_name, unit)
 
             if food_item:
                 print(f"在本地数据库中找到食物: {food_name}")
                 food_results.append((i, food_item))
                 continue
-            else:
-                print(f"在本地数据库中未找到食物: {food_name}")
-                not_in_local.append((i, {"food_name": food_name, "unit": unit}))
+            print(f"在本地数据库中未找到食物: {food_name}")
+            not_in_local.append((i, food_name, unit))
 
         if not_in_local:
-            llm_food_result = self.llm_service.get_food_nutrition(
-                [food[1] for food in not_in_local]
+            # 同一描述中重复的食物只查找一次
+            found = self.resolve_unknown_foods(
+                [(food_name, unit) for _, food_name, unit in not_in_local]
             )
-            for food_item in llm_food_result:
-                print(f"写入本地数据库: {food_item.name, food_item.unit}")
-                self.add_to_db(food_item)
             food_results.extend(
-                list(zip([food[0] for food in not_in_local], llm_food_result))
+                (i, found[normalize_key(food_name, unit)])
+                for i, food_name, unit in not_in_local
             )
         food_results.sort(key=lambda x: x[0])
         food_results = [food[1] for food in food_results]
         return quantities, food_results
 
+    def _entry_foods_from_notion(self, entry_id):
+        """本地没有记录时读取条目页面并补录到本地，食物从本地按ID取，不再逐个GET"""
+        try:
+            page = self.notion.get_page(entry_id)
+            if not page:
+                return None
+            notion_ids, quantities = entry_foods(page)
+        except Exception as e:
+            print(f"获取条目失败: {entry_id}, {e}")
+            return None
+        food_items = self.local_db.get_food_items_by_ids(notion_ids)
+        if food_items is None:
+            return None
+        self.local_db.record_entry(
+            entry_id, food_items, quantities, notion_timestamp(page.get("created_time"))
+        )
+        return food_items, quantities
+
     def update_food_item(self):
+        """把Notion中标记为'异常'的食物更新到本地，并重新计算关联条目的总热量
+
+        关联条目从本地反向索引读取；索引补录完成前再合并Notion中的关联，
+        只有本地没有记录的条目才读取条目页面。"""
 
         # self.notion.delete_no_association_food()
         to_update_foods = self.notion.get_update_food()
@@ -78,29 +268,44 @@ class FoodAgent:
             return
         print(f"需要更新的食物: {to_update_foods}")
         for food in to_update_foods:
-            food_item = self.local_db.get_food_item_by_id(food)
-            if food_item:
-                self.local_db.update_food_item(food_item)
-
-                print(f"更新食物: {food.name}")
-            else:
-                print(f"未找到食物: {food.name}")
-            associations = self.notion.get_updated_associations(food)
-            if associations:
-                for association in associations:
-                    entry_id = association["id"]
-                    food_items, quantities = self.notion.get_food_item_and_quantities(
-                        entry_id
-                    )
-                    try:
-                        self.notion.update_main_database(
-                            entry_id, food_items, quantities
-                        )
-                        self.notion.fix_updated_status(food_item)
-                    except Exception as e:
-                        print(f"更新主数据库失败: {e}")
+            # get_update_food返回的是Notion中的最新值，直接写入本地
+            self.local_db.add_food_item(food)
+            print(f"更新食物: {food.name}")
 
-        self.local_db.sync_database()
+            all_updated = True
+            entry_ids = self.local_db.get_entries_for_food(food.notion_id)
+            if not self.local_db.entry_index_complete():
+                # 索引建立前处理的条目只在Notion的关联中
+                associations = self.notion.get_updated_associations(food)
+                if associations is None:
+                    all_updated = False
+                entry_ids = list(
+                    dict.fromkeys(
+                        entry_ids
+                        + [association["id"] for association in associations or []]
+                    )
+                )
+            for entry_id in entry_ids:
+                entry_foods = self.local_db.get_entry_foods(entry_id)
+                if entry_foods is None:
+                    entry_foods = self._entry_foods_from_notion(entry_id)
+                if entry_foods is None:
+                    all_updated = False
+                    continue
+                food_items, quantities = entry_foods
+                try:
+                    if self.notion.update_main_database(
+                        entry_id, food_items, quantities
+                    ):
+                        # 刷新本地镜像中的营养合计
+                        self.local_db.record_entry(entry_id, food_items, quantities)
+                    else:
+                        all_updated = False
+                except Exception as e:
+                    all_updated = False
+                    print(f"更新主数据库失败: {e}")
+            if all_updated:
+                self.notion.fix_updated_status(food)
 
 
 if __name__ == "__main__":
@@ -109,7 +314,7 @@ if __name__ == "__main__":
     start_time_total = time.time()
 
     food_agent = FoodAgent()
-    food_agent.local_db.sync_database()
+    food_agent.local_db.sync_database(food_agent.notion)
     # existing_all = food_agent.local_db.get_all_food_items()
     # for food in existing_all:
     #     print(food)
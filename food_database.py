@@ -1,17 +1,136 @@
+import json
+import os
+from collections import OrderedDict
 import sqlite3
+import threading
+import time
 from FoodItem import FoodItem
+from fuzzy_match import NgramIndex, char_coverage
+from metrics import STAGE_DURATION
 
 
-class LocalFoodDatabase:
-    def __init__(self, db_path="food_database.db"):
-        self.conn = sqlite3.connect(db_path)
-        self.cursor = self.conn.cursor()
-        self._create_tables()
+# 增量同步之间做一次全量对账(处理Notion端删除)的间隔(秒)
+FULL_SYNC_INTERVAL = float(os.getenv("FOOD_FULL_SYNC_INTERVAL", "3600"))
+# 本地查询LRU缓存的最大条目数，0表示不缓存
+FOOD_CACHE_SIZE = int(os.getenv("FOOD_CACHE_SIZE", "1024"))
 
-    def _create_tables(self):
-        """创建食物数据表"""
-        self.cursor.execute(
-            """
+# 写锁被占用时等待的毫秒数，超时才报database is locked
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+# 每个连接的页缓存大小(KiB)
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "8192"))
+# 每个连接缓存的预编译语句数
+SQLITE_CACHED_STATEMENTS = int(os.getenv("SQLITE_CACHED_STATEMENTS", "256"))
+
+# 参与内容哈希的字段，顺序与SQL中的列顺序一致
+FOOD_FIELDS = ("name", "calories", "unit", "protein", "fat", "carbs", "grams")
+# 条目合计的营养字段，顺序与entries表中的列顺序一致
+NUTRIENT_FIELDS = ("calories", "protein", "fat", "carbs")
+# sync_state中的标记: 迁移3之前处理的条目已补录到食物 -> 条目反向索引
+ENTRY_INDEX_BACKFILLED = "entry_index_backfilled"
+
+
+class LRUCache:
+    """线程安全、容量有限的LRU缓存，记录命中率
+
+    generation在每次clear时加1。读穿透时先取generation再读数据库，
+    set时带上它: 期间被清空过说明读到的可能是旧值，不再写入缓存。"""
+
+    _missing = object()
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.data.get(key, self._missing)
+            if value is self._missing:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """generation: 读取value前的self.generation，之后被清空过时不写入"""
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.data.clear()
+
+    def stats(self):
+        """return: {"hits", "misses", "hit_rate", "size"}"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self.data),
+            }
+
+
+def food_row(food_item):
+    """FoodItem -> 与food_items列顺序一致的元组(数值统一为float)"""
+    row = []
+    for field in FOOD_FIELDS:
+        value = getattr(food_item, field)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = float(value)
+        row.append(value)
+    return tuple(row)
+
+
+def diff_food_rows(local_rows, remote_rows):
+    """按notion_id集合比较本地与远端数据，共有的行直接按内容比较
+
+    哈希相同不代表内容相同，直接比较元组既精确又不比计算哈希慢
+
+    local_rows / remote_rows: {notion_id: row}
+    return: {"added": [(notion_id, row)], "modified": [...], "removed": [notion_id]}"""
+    local_ids = local_rows.keys()
+    remote_ids = remote_rows.keys()
+    added = [(i, remote_rows[i]) for i in remote_ids - local_ids]
+    removed = list(local_ids - remote_ids)
+    modified = [
+        (i, remote_rows[i])
+        for i in remote_ids & local_ids
+        if remote_rows[i] != local_rows[i]
+    ]
+    return {"added": added, "modified": modified, "removed": removed}
+
+
+def collect_food_rows(food_items, watermark=None):
+    """return: ({notion_id: row}, 读取到的最新last_edited_time(不早于watermark))"""
+    remote_rows = {}
+    new_watermark = watermark
+    for food_item in food_items:
+        remote_rows[food_item.notion_id] = food_row(food_item)
+        edited = food_item.last_edited_time
+        if edited and (new_watermark is None or edited > new_watermark):
+            new_watermark = edited
+    return remote_rows, new_watermark
+
+
+# 数据库结构迁移，第i项把user_version从i升级到i+1，只能追加不能修改
+MIGRATIONS = [
+    # 1: 初始结构
+    [
+        """
         CREATE TABLE IF NOT EXISTS food_items (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT,
@@ -23,211 +142,673 @@ class LocalFoodDatabase:
             grams REAL,
             notion_id TEXT
         )
+        """,
         """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
         )
-        self.conn.commit()
+        """,
+    ],
+    # 2: notion_id唯一约束和(name, unit)索引，之后不再需要启动时去重
+    [
+        """
+        DELETE FROM food_items
+        WHERE notion_id IS NOT NULL AND id NOT IN (
+            SELECT MIN(id)
+            FROM food_items
+            WHERE notion_id IS NOT NULL
+            GROUP BY notion_id
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_food_items_notion_id ON food_items (notion_id)",
+        "CREATE INDEX IF NOT EXISTS idx_food_items_name_unit ON food_items (name, unit)",
+    ],
+    # 3: 已处理条目的数量和关联食物，以及食物 -> 条目的反向索引
+    [
+        """
+        CREATE TABLE IF NOT EXISTS entries (
+            entry_id TEXT PRIMARY KEY,
+            quantities TEXT,
+            updated_at REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS entry_foods (
+            entry_id TEXT,
+            position INTEGER,
+            notion_id TEXT,
+            PRIMARY KEY (entry_id, position)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_entry_foods_notion_id ON entry_foods (notion_id)",
+    ],
+    # 4: 条目的记录时间和营养合计，本地统计不再需要读取Notion
+    [
+        "ALTER TABLE entries ADD COLUMN logged_at REAL",
+        "ALTER TABLE entries ADD COLUMN calories REAL",
+        "ALTER TABLE entries ADD COLUMN protein REAL",
+        "ALTER TABLE entries ADD COLUMN fat REAL",
+        "ALTER TABLE entries ADD COLUMN carbs REAL",
+        "CREATE INDEX IF NOT EXISTS idx_entries_logged_at ON entries (logged_at)",
+        "ALTER TABLE entry_foods ADD COLUMN quantity REAL",
+        """
+        UPDATE entry_foods SET quantity = (
+            SELECT json_extract(entries.quantities, '$[' || entry_foods.position || ']')
+            FROM entries WHERE entries.entry_id = entry_foods.entry_id
+        )
+        """,
+    ],
+]
+
+# 按notion_id插入或更新；notion_id为NULL时总是插入
+UPSERT_FOOD_SQL = """INSERT INTO food_items 
+   (name, calories, unit, protein, fat, carbs, grams, notion_id) 
+   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+   ON CONFLICT (notion_id) DO UPDATE SET
+   name=excluded.name, calories=excluded.calories, unit=excluded.unit,
+   protein=excluded.protein, fat=excluded.fat, carbs=excluded.carbs,
+   grams=excluded.grams"""
+UPDATE_FOOD_BY_ID_SQL = """UPDATE food_items SET 
+   name=?, calories=?, unit=?, protein=?, fat=?, carbs=?, grams=?
+   WHERE notion_id=?"""
+SET_SYNC_STATE_SQL = "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)"
+SELECT_FOOD_SQL = (
+    "SELECT name, calories, unit, protein, fat, carbs, grams, notion_id FROM food_items"
+)
+# 重新记录条目时保留已有的记录时间
+UPSERT_ENTRY_SQL = """INSERT INTO entries
+   (entry_id, quantities, updated_at, logged_at, calories, protein, fat, carbs)
+   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+   ON CONFLICT (entry_id) DO UPDATE SET
+   quantities=excluded.quantities, updated_at=excluded.updated_at,
+   logged_at=COALESCE(excluded.logged_at, entries.logged_at),
+   calories=excluded.calories, protein=excluded.protein, fat=excluded.fat,
+   carbs=excluded.carbs"""
+
+
+def connect(db_path):
+    """打开一个WAL模式的连接
+
+    WAL下读不阻塞写、写不阻塞读；synchronous=NORMAL只在检查点时fsync，
+    断电最多丢失最近的事务而不会损坏数据库。写事务以BEGIN IMMEDIATE开始，
+    并发写入在busy_timeout内排队，而不是在读升级为写时直接报错。"""
+    conn = sqlite3.connect(
+        db_path,
+        timeout=SQLITE_BUSY_TIMEOUT / 1000,
+        isolation_level="IMMEDIATE",
+        check_same_thread=False,
+        cached_statements=SQLITE_CACHED_STATEMENTS,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def entry_totals(food_items, quantities):
+    """return: (热量, 蛋白质, 脂肪, 碳水)合计，缺少的营养值按0计"""
+    totals = [0.0] * len(NUTRIENT_FIELDS)
+    for food_item, quantity in zip(food_items, quantities):
+        for i, field in enumerate(NUTRIENT_FIELDS):
+            value = getattr(food_item, field)
+            if value is not None:
+                totals[i] += value * quantity
+    return tuple(totals)
+
+
+def _food_keys(conn, notion_ids):
+    """return: 这些notion_id当前对应的{(名称, 单位)}"""
+    return set(
+        conn.execute(
+            """SELECT name, unit FROM food_items
+               WHERE notion_id IN (SELECT value FROM json_each(?))""",
+            (json.dumps(list(notion_ids)),),
+        )
+    )
+
+
+def _food_from_row(result):
+    food = FoodItem(
+        name=result[0],
+        calories=result[1],
+        unit=result[2],
+        protein=result[3],
+        fat=result[4],
+        carbs=result[5],
+        grams=result[6],
+    )
+    food.notion_id = result[7]
+    return food
+
+
+class ThreadLocalDatabase:
+    """每个线程使用自己的WAL连接，可在多个线程和进程间共享同一数据库文件
+
+    子类在migrations中给出结构迁移，见MIGRATIONS。线程结束后它的连接
+    在下次有线程打开连接时关闭，每轮新建的线程池不会累积连接和文件描述符。"""
+
+    migrations = []
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        # 线程 -> 连接，close时一并关闭
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+        self._create_tables()
+
+    @property
+    def conn(self):
+        """当前线程的连接，第一次使用时打开"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = connect(self.db_path)
+            self.local.conn = conn
+            with self.connections_lock:
+                for thread in [t for t in self.connections if not t.is_alive()]:
+                    self.connections.pop(thread).close()
+                self.connections[threading.current_thread()] = conn
+        return conn
+
+    def _create_tables(self):
+        """按PRAGMA user_version依次执行未应用的迁移"""
+        conn = self.conn
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        for target, statements in enumerate(
+            self.migrations[version:], start=version + 1
+        ):
+            with conn:
+                # DDL不会隐式开始事务，显式加写锁，避免多个进程同时迁移
+                conn.execute("BEGIN IMMEDIATE")
+                (current,) = conn.execute("PRAGMA user_version").fetchone()
+                if current >= target:
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {target}")
+
+    def close(self):
+        """关闭所有线程打开的数据库连接"""
+        with self.connections_lock:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+
+class LocalFoodDatabase(ThreadLocalDatabase):
+    """本地食物库，每个线程使用自己的连接，可在多个线程和进程间共享同一文件"""
+
+    migrations = MIGRATIONS
+
+    def __init__(self, db_path="food_database.db"):
+        # 保护n-gram索引的构建、增删和查询，数据库访问由SQLite自身加锁
+        self.index_lock = threading.Lock()
+        # get_food_item / get_food_item_by_id的读缓存，任何写操作都会清空
+        self.cache = LRUCache(FOOD_CACHE_SIZE)
+        # 相似名称匹配用的n-gram索引，懒加载，之后随写入逐行更新
+        self.ngram_index = None
+        super().__init__(db_path)
+
+    def get_sync_state(self, key, default=None):
+        """读取同步状态(如last_edited_time水位线)"""
+        result = self.conn.execute(
+            "SELECT value FROM sync_state WHERE key=?", (key,)
+        ).fetchone()
+        return result[0] if result else default
+
+    def set_sync_state(self, key, value):
+        """写入同步状态"""
+        with self.conn as conn:
+            conn.execute(SET_SYNC_STATE_SQL, (key, value))
 
     def add_food_item(self, food_item):
-        """添加新食物到数据库"""
+        """添加新食物到数据库，notion_id已存在时更新该行"""
+        keys = {(food_item.name, food_item.unit)}
         try:
-            self.cursor.execute(
-                """INSERT INTO food_items 
-                   (name, calories, unit, protein, fat, carbs, grams, notion_id) 
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                (
-                    food_item.name,
-                    food_item.calories,
-                    food_item.unit,
-                    food_item.protein,
-                    food_item.fat,
-                    food_item.carbs,
-                    food_item.grams,
-                    food_item.notion_id,
-                ),
-            )
-            self.conn.commit()
+            with self.conn as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if food_item.notion_id:
+                    keys |= _food_keys(conn, [food_item.notion_id])
+                conn.execute(
+                    UPSERT_FOOD_SQL,
+                    (
+                        food_item.name,
+                        food_item.calories,
+                        food_item.unit,
+                        food_item.protein,
+                        food_item.fat,
+                        food_item.carbs,
+                        food_item.grams,
+                        food_item.notion_id,
+                    ),
+                )
+            self._invalidate(keys)
             return True
         except sqlite3.IntegrityError:
             # 食物名已存在
             return False
 
     def update_food_item(self, food_item):
-        """更新食物信息"""
-        self.cursor.execute(
-            """UPDATE food_items SET 
-               calories=?, unit=?, protein=?, fat=?, carbs=?, grams=?, notion_id=?
-               WHERE name=?""",
-            (
-                food_item.calories,
-                food_item.unit,
-                food_item.protein,
-                food_item.fat,
-                food_item.carbs,
-                food_item.notion_id,
-                food_item.grams,
-                food_item.name,
-            ),
-        )
-        self.conn.commit()
-        return self.cursor.rowcount > 0
+        """更新食物信息
+
+        有notion_id时按notion_id匹配(允许改名)，否则按名称匹配"""
+        keys = {(food_item.name, food_item.unit)}
+        with self.conn as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if food_item.notion_id:
+                keys |= _food_keys(conn, [food_item.notion_id])
+                cursor = conn.execute(
+                    UPDATE_FOOD_BY_ID_SQL,
+                    (
+                        food_item.name,
+                        food_item.calories,
+                        food_item.unit,
+                        food_item.protein,
+                        food_item.fat,
+                        food_item.carbs,
+                        food_item.grams,
+                        food_item.notion_id,
+                    ),
+                )
+            else:
+                keys |= set(
+                    conn.execute(
+                        "SELECT name, unit FROM food_items WHERE name=?",
+                        (food_item.name,),
+                    )
+                )
+                cursor = conn.execute(
+                    """UPDATE food_items SET 
+                       calories=?, unit=?, protein=?, fat=?, carbs=?, grams=?
+                       WHERE name=?""",
+                    (
+                        food_item.calories,
+                        food_item.unit,
+                        food_item.protein,
+                        food_item.fat,
+                        food_item.carbs,
+                        food_item.grams,
+                        food_item.name,
+                    ),
+                )
+        self._invalidate(keys)
+        return cursor.rowcount > 0
 
     def delete_food_item(self, name, notion_id=None):
         if notion_id:
-            self.cursor.execute(
-                "DELETE FROM food_items WHERE name=? AND notion_id=?", (name, notion_id)
-            )
-            self.conn.commit()
+            with self.conn as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                keys = _food_keys(conn, [notion_id])
+                conn.execute(
+                    "DELETE FROM food_items WHERE name=? AND notion_id=?",
+                    (name, notion_id),
+                )
+            self._invalidate(keys)
             return True
         if self.get_food_item(name):
-            self.cursor.execute("DELETE FROM food_items WHERE name=?", (name,))
-            self.conn.commit()
+            with self.conn as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                keys = set(
+                    conn.execute(
+                        "SELECT name, unit FROM food_items WHERE name=?", (name,)
+                    )
+                )
+                conn.execute("DELETE FROM food_items WHERE name=?", (name,))
+            self._invalidate(keys)
             return True
         else:
             return False
 
     def get_all_food_items(self):
         """return:  [FoodItem...]"""
-        self.cursor.execute(
-            "SELECT name, calories, unit, protein, fat, carbs, grams, notion_id FROM food_items"
-        )
-        results = self.cursor.fetchall()
-        food_items = []
-        for result in results:
-            food = FoodItem(
-                name=result[0],
-                calories=result[1],
-                unit=result[2],
-                protein=result[3],
-                fat=result[4],
-                carbs=result[5],
-                grams=result[6],
-            )
-            food.notion_id = result[7]
-            food_items.append(food)
-        return food_items
+        results = self.conn.execute(SELECT_FOOD_SQL).fetchall()
+        return [_food_from_row(result) for result in results]
 
     def get_food_item(self, name, unit=None):
-        """根据名称和可选单位获取食物信息
+        """根据名称和可选单位获取食物信息(经过LRU缓存)
+
+        返回的FoodItem为缓存共享对象，调用方不应修改
         return : FoodItem or None"""
+        key = ("name", name, unit)
+        food = self.cache.get(key, LRUCache._missing)
+        if food is LRUCache._missing:
+            generation = self.cache.generation
+            food = self._query_food_item(name, unit)
+            self.cache.set(key, food, generation)
+        return food
+
+    def get_food_item_by_id(self, food_item: FoodItem):
+        """根据ID获取食物信息(经过LRU缓存)"""
+        key = ("id", food_item.notion_id)
+        food = self.cache.get(key, LRUCache._missing)
+        if food is LRUCache._missing:
+            generation = self.cache.generation
+            food = self._query_food_item_by_id(food_item.notion_id)
+            self.cache.set(key, food, generation)
+        return food
+
+    def _invalidate(self, keys=None):
+        """表内容变化后清空读缓存并更新n-gram索引
+
+        keys: 写入前后涉及的{(名称, 单位)}，按写入后表中是否还有该名称和单位
+              逐行增删索引；None时丢弃整个索引，下次查询重建"""
+        self.cache.clear()
+        with self.index_lock:
+            if self.ngram_index is None:
+                return
+            if keys is None:
+                self.ngram_index = None
+                return
+            for name, unit in keys:
+                exists = self.conn.execute(
+                    "SELECT 1 FROM food_items WHERE name=? AND unit IS ? LIMIT 1",
+                    (name, unit),
+                ).fetchone()
+                if exists:
+                    self.ngram_index.add(name, unit)
+                else:
+                    self.ngram_index.remove(name, unit)
+
+    def cache_stats(self):
+        """本地查询缓存的命中统计"""
+        return self.cache.stats()
+
+    def _query_food_item(self, name, unit=None):
         if unit:
             # 如果提供了单位，同时匹配名称和单位
-            self.cursor.execute(
-                "SELECT name, calories, unit, protein, fat, carbs, grams, notion_id FROM food_items WHERE name=? AND unit=?",
-                (name, unit),
-            )
+            result = self.conn.execute(
+                SELECT_FOOD_SQL + " WHERE name=? AND unit=?", (name, unit)
+            ).fetchone()
         else:
             # 如果没有提供单位，只匹配名称
-            self.cursor.execute(
-                "SELECT name, calories, unit, protein, fat, carbs, grams, notion_id FROM food_items WHERE name=?",
-                (name,),
-            )
+            result = self.conn.execute(
+                SELECT_FOOD_SQL + " WHERE name=?", (name,)
+            ).fetchone()
+        return _food_from_row(result) if result else None
 
-        result = self.cursor.fetchone()
-        if result:
-            food = FoodItem(
-                name=result[0],
-                calories=result[1],
-                unit=result[2],
-                protein=result[3],
-                fat=result[4],
-                carbs=result[5],
-                grams=result[6],
-            )
-            food.notion_id = result[7]
-            return food
-        return None
+    def _query_food_item_by_id(self, notion_id):
+        result = self.conn.execute(
+            SELECT_FOOD_SQL + " WHERE notion_id=?", (notion_id,)
+        ).fetchone()
+        return _food_from_row(result) if result else None
 
-    def get_food_item_by_id(self, food_item: FoodItem):
-        """根据ID获取食物信息"""
-        self.cursor.execute(
-            "SELECT name, calories, unit, protein, fat, carbs, grams, notion_id FROM food_items WHERE notion_id=?",
-            (food_item.notion_id,),
-        )
-        result = self.cursor.fetchone()
-        if result:
-            food = FoodItem(
-                name=result[0],
-                calories=result[1],
-                unit=result[2],
-                protein=result[3],
-                fat=result[4],
-                carbs=result[5],
-                grams=result[6],
-            )
-            food.notion_id = result[7]
-            return food
-        return None
+    def record_entry(self, entry_id, food_items, quantities, logged_at=None):
+        """记录条目的关联食物、数量和营养合计，维护食物 -> 条目的反向索引
 
-    def search_similar_foods(self, name, threshold=0.7):
-        """搜索相似食物名称(简单实现)"""
-        self.cursor.execute("SELECT name FROM food_items")
-        all_foods = self.cursor.fetchall()
-        similar_foods = []
+        logged_at: 条目的记录时间(Unix时间戳)，None时保留已有的值"""
+        self.record_entries([(entry_id, food_items, quantities, logged_at)])
 
-        for food_name in all_foods:
-            # 简单的相似度计算，实际应用中可以使用更复杂的算法
-            similarity = self._calculate_similarity(name, food_name[0])
-            if similarity >= threshold:
-                similar_foods.append(food_name[0])
+    def record_entries(self, entries):
+        """在一个事务中记录多个条目
 
-        return similar_foods
+        entries: [(条目ID, [FoodItem, ...], [数量, ...], 记录时间), ...]"""
+        now = time.time()
+        with self.conn as conn:
+            for entry_id, food_items, quantities, logged_at in entries:
+                conn.execute(
+                    UPSERT_ENTRY_SQL,
+                    (entry_id, json.dumps(quantities), now, logged_at)
+                    + entry_totals(food_items, quantities),
+                )
+                conn.execute("DELETE FROM entry_foods WHERE entry_id=?", (entry_id,))
+                conn.executemany(
+                    "INSERT INTO entry_foods (entry_id, position, notion_id, quantity) VALUES (?, ?, ?, ?)",
+                    [
+                        (entry_id, position, food_item.notion_id, quantity)
+                        for position, (food_item, quantity) in enumerate(
+                            zip(food_items, quantities)
+                        )
+                    ],
+                )
 
-    def _calculate_similarity(self, str1, str2):
-        """简单的字符串相似度计算"""
-        # 这里使用简单的方法，实际应用可以使用更复杂的算法如编辑距离
-        # 或者中文分词后的余弦相似度等
-        str1 = str1.lower()
-        str2 = str2.lower()
+    def get_entry_totals(self, start=None, end=None):
+        """按记录时间读取条目的营养合计，不含没有记录时间的条目
 
-        # 检查一个字符串是否包含另一个
-        if str1 in str2 or str2 in str1:
-            return 0.8
+        start / end: Unix时间戳，包含start不包含end
+        return: [(记录时间, 热量, 蛋白质, 脂肪, 碳水), ...]，按时间排序"""
+        return self.conn.execute(
+            """SELECT logged_at, calories, protein, fat, carbs FROM entries
+               WHERE logged_at >= ? AND logged_at < ? ORDER BY logged_at""",
+            (
+                float("-inf") if start is None else start,
+                float("inf") if end is None else end,
+            ),
+        ).fetchall()
 
-        # 计算重叠字符比例
-        common_chars = set(str1) & set(str2)
-        return len(common_chars) / max(len(set(str1)), len(set(str2)))
+    def get_top_foods(self, start=None, end=None, k=10):
+        """时间范围内按摄入热量排序的食物
 
-    def close(self):
-        """关闭数据库连接"""
-        self.conn.close()
+        return: [(名称, 单位, 出现次数, 总数量, 总热量), ...]"""
+        return self.conn.execute(
+            """SELECT food_items.name, food_items.unit, eaten.count, eaten.quantity,
+                      eaten.quantity * food_items.calories AS total
+               FROM (
+                   SELECT entry_foods.notion_id, COUNT(*) AS count,
+                          SUM(entry_foods.quantity) AS quantity
+                   FROM entries JOIN entry_foods USING (entry_id)
+                   WHERE entries.logged_at >= ? AND entries.logged_at < ?
+                   GROUP BY entry_foods.notion_id
+               ) AS eaten
+               JOIN food_items ON food_items.notion_id = eaten.notion_id
+               ORDER BY total DESC LIMIT ?""",
+            (
+                float("-inf") if start is None else start,
+                float("inf") if end is None else end,
+                k,
+            ),
+        ).fetchall()
+
+    def entry_index_complete(self):
+        """反向索引是否包含全部条目(已运行analytics.py backfill)
+
+        未补录时，迁移3之前处理的条目只能从Notion食物页面的关联中找到"""
+        return self.get_sync_state(ENTRY_INDEX_BACKFILLED) is not None
+
+    def get_entries_for_food(self, notion_id):
+        """return: 关联了该食物的条目ID列表"""
+        results = self.conn.execute(
+            "SELECT DISTINCT entry_id FROM entry_foods WHERE notion_id=?", (notion_id,)
+        ).fetchall()
+        return [result[0] for result in results]
+
+    def get_entry_foods(self, entry_id):
+        """从本地读取条目的食物和数量
+
+        return: ([FoodItem, ...], [数量, ...])；条目未记录或食物缺失时返回None"""
+        conn = self.conn
+        # 在一个读事务中读取，看到的是同一个快照
+        with conn:
+            conn.execute("BEGIN")
+            result = conn.execute(
+                "SELECT quantities FROM entries WHERE entry_id=?", (entry_id,)
+            ).fetchone()
+            if not result:
+                return None
+            quantities = json.loads(result[0])
+            notion_ids = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT notion_id FROM entry_foods WHERE entry_id=? ORDER BY position",
+                    (entry_id,),
+                )
+            ]
+            food_items = self.get_food_items_by_ids(notion_ids)
+        if food_items is None:
+            return None
+        return food_items, quantities
+
+    def get_food_items_by_ids(self, notion_ids):
+        """return: 与notion_ids顺序一致的[FoodItem, ...]；有任一缺失时返回None"""
+        food_items = []
+        for notion_id in notion_ids:
+            food_item = self._query_food_item_by_id(notion_id)
+            if food_item is None:
+                return None
+            food_items.append(food_item)
+        return food_items
+
+    def _get_ngram_index(self):
+        """懒加载n-gram索引，调用方需持有index_lock"""
+        if self.ngram_index is None:
+            self.ngram_index = NgramIndex(
+                self.conn.execute("SELECT DISTINCT name, unit FROM food_items")
+            )
+        return self.ngram_index
+
+    def search_similar_foods(self, name, threshold=0.7, unit=None, k=5):
+        """按字符n-gram余弦相似度搜索相似食物
+
+        return: [(名称, 单位, 相似度), ...]，按相似度降序"""
+        with self.index_lock:
+            matches = self._get_ngram_index().query(name, k=k, unit=unit)
+        return [
+            (food_name, food_unit, score)
+            for (food_name, food_unit), score in matches
+            if score >= threshold
+        ]
+
+    def find_close_match(self, name, unit, threshold, coverage=0.9):
+        """返回同单位下相似度不低于threshold的最佳匹配食物，没有则返回None
+
+        coverage: 两个名称的字符互相覆盖的最低比例。只加减一两个字的名称
+            ("炒米饭"和"米饭")余弦相似度也很高，但通常是不同的食物"""
+        for food_name, food_unit, score in self.search_similar_foods(
+            name, threshold, unit=unit
+        ):
+            if (
+                min(char_coverage(name, food_name), char_coverage(food_name, name))
+                >= coverage
+            ):
+                print(f"相似食物匹配: {name} -> {food_name} ({score:.2f})")
+                return self.get_food_item(food_name, food_unit)
+        return None
 
     def clear_database(self):
         """清空数据库"""
-        self.cursor.execute("DELETE FROM food_items")
-        self.conn.commit()
+        with self.conn as conn:
+            conn.execute("DELETE FROM food_items")
+        self._invalidate()
         self.close()
 
-    def remove_duplicate_food_items(self):
-        """删除重复的食物项"""
-        self.cursor.execute(
-            """
-            DELETE FROM food_items
-            WHERE id NOT IN (
-                SELECT MIN(id)
-                FROM food_items
-                GROUP BY notion_id
+    def sync_database(self, notion=None, full=None):
+        """向notion同步数据库
+
+        默认做增量同步：只拉取last_edited_time不早于水位线的页面。
+        没有水位线或距上次全量对账超过FULL_SYNC_INTERVAL时做全量同步，
+        以清理Notion端已删除的食物。
+
+        notion: 复用的Notion客户端，默认新建(共享同一连接池)
+        full: True强制全量，False强制增量，None自动选择"""
+        if notion is None:
+            from notion import Notion
+
+            notion = Notion()
+        full, watermark = self.plan_sync(full)
+        with STAGE_DURATION.time(stage="sync"):
+            started_at = time.time()
+            start = time.perf_counter()
+            try:
+                if full:
+                    food_items = notion.iter_all_food_items()
+                else:
+                    food_items = notion.iter_food_items_edited_since(watermark)
+                remote_rows, new_watermark = collect_food_rows(
+                    food_items, None if full else watermark
+                )
+            except Exception as e:
+                # 读取不完整时不能做删除，否则会误删本地数据
+                print(f"同步Notion数据库失败: {e}")
+                return False
+            fetch_time = time.perf_counter() - start
+            return self.apply_sync(
+                full, remote_rows, new_watermark, started_at, fetch_time
             )
-            """
+
+    def plan_sync(self, full=None):
+        """决定本次同步方式
+
+        return: (是否全量, 水位线)"""
+        watermark = self.get_sync_state("food_watermark")
+        last_full_sync = float(self.get_sync_state("last_full_sync", 0))
+        if full is None:
+            full = time.time() - last_full_sync >= FULL_SYNC_INTERVAL
+        return full or watermark is None, watermark
+
+    def _get_local_rows(self):
+        """return: {notion_id: row}"""
+        results = self.conn.execute(
+            "SELECT notion_id, name, calories, unit, protein, fat, carbs, grams FROM food_items"
         )
-        self.conn.commit()
-
-    def sync_database(self):
-        """向notion同步数据库"""
-        from notion import Notion
-
-        notion = Notion()
-        notion_food_items = notion.get_all_food_items()
-        local_food_items = self.get_all_food_items()
-        for food_item in local_food_items:
-            if food_item.notion_id not in [
-                item.notion_id for item in notion_food_items
-            ]:
-                # 如果本地数据库中有食物，但Notion中没有，则从本地删除
-                self.delete_food_item(food_item.name, food_item.notion_id)
-        for food_item in notion_food_items:
-            if food_item.notion_id not in [item.notion_id for item in local_food_items]:
-                # 如果Notion中有食物，但本地数据库中没有，则添加到本地数据库
-                self.add_food_item(food_item)
+        return {result[0]: tuple(result[1:]) for result in results}
+
+    def _apply_food_diff(self, diff, sync_state=None):
+        """在一个事务中用executemany写入差异
+
+        sync_state: {键: 值}，与差异在同一事务中写入，整次同步只提交一次。
+        差异为空时不清空缓存和索引(每轮同步都会调用)"""
+        changed = diff["added"] + diff["modified"]
+        keys = {(row[0], row[2]) for _, row in changed}
+        with self.conn as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            keys |= _food_keys(
+                conn, [notion_id for notion_id, _ in changed] + diff["removed"]
+            )
+            conn.executemany(
+                UPSERT_FOOD_SQL,
+                [row + (notion_id,) for notion_id, row in diff["added"]],
+            )
+            conn.executemany(
+                UPDATE_FOOD_BY_ID_SQL,
+                [row + (notion_id,) for notion_id, row in diff["modified"]],
+            )
+            conn.executemany(
+                "DELETE FROM food_items WHERE notion_id=?",
+                [(notion_id,) for notion_id in diff["removed"]],
+            )
+            conn.executemany(SET_SYNC_STATE_SQL, (sync_state or {}).items())
+        if changed or diff["removed"]:
+            self._invalidate(keys)
+
+    def _sync_stats(self, mode, diff, timings):
+        stats = {
+            "mode": mode,
+            "added": len(diff["added"]),
+            "modified": len(diff["modified"]),
+            "removed": len(diff["removed"]),
+        }
+        stats.update({f"{k}_ms": round(v * 1000, 2) for k, v in timings.items()})
+        print(f"同步完成: {stats}")
+        return stats
+
+    def apply_sync(self, full, remote_rows, new_watermark, started_at, fetch_time=0):
+        """把从Notion读取的行与本地对账并写入
+
+        全量时删除Notion中已不存在的食物；增量时只比较读取到的行。
+        remote_rows, new_watermark: 见collect_food_rows
+        started_at: 开始读取的时间，全量时记为last_full_sync"""
+        timings = {"fetch": fetch_time}
+        start = time.perf_counter()
+        local_rows = self._get_local_rows()
+        if not full:
+            local_rows = {
+                i: local_rows[i] for i in remote_rows.keys() & local_rows.keys()
+            }
+        diff = diff_food_rows(local_rows, remote_rows)
+        timings["diff"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sync_state = {}
+        if new_watermark:
+            sync_state["food_watermark"] = new_watermark
+        if full:
+            sync_state["last_full_sync"] = str(started_at)
+        self._apply_food_diff(diff, sync_state)
+        timings["apply"] = time.perf_counter() - start
+        return self._sync_stats("full" if full else "incremental", diff, timings)
 
 
 if __name__ == "__main__":
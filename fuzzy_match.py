@@ -0,0 +1,109 @@
+import heapq
+import math
+import unicodedata
+from collections import Counter
+
+
+def char_ngrams(text, n_values=(1, 2)):
+    """提取字符n-gram(默认单字和双字)，先做NFKC规范化和小写"""
+    text = "".join(unicodedata.normalize("NFKC", text or "").lower().split())
+    grams = []
+    for n in n_values:
+        grams.extend(text[i : i + n] for i in range(len(text) - n + 1))
+    return grams
+
+
+def char_coverage(text, other):
+    """text的字符(按出现次数计)中有多大比例也出现在other中"""
+    chars = Counter(char_ngrams(text, (1,)))
+    total = sum(chars.values())
+    if not total:
+        return 0.0
+    return sum((chars & Counter(char_ngrams(other, (1,)))).values()) / total
+
+
+class NgramIndex:
+    """字符n-gram倒排索引，按余弦相似度查询
+
+    每个(名称, 单位)是一行n-gram计数向量，只保存n-gram -> {行号: 次数}的倒排表，
+    内存与n-gram总数成正比；支持逐行增删，表有写入时不必整体重建。
+    不是线程安全的，并发使用时由调用方加锁。
+    """
+
+    def __init__(self, entries=(), n_values=(1, 2)):
+        """entries: [(名称, 单位), ...]"""
+        self.n_values = n_values
+        self.build(entries)
+
+    def build(self, entries):
+        # (名称, 单位) -> 行号
+        self.rows = {}
+        # 行号 -> (名称, 单位)，已删除的行为None，行号由free复用
+        self.entries = []
+        self.norms = []
+        self.free = []
+        # n-gram -> {行号: 次数}
+        self.postings = {}
+        for name, unit in entries:
+            self.add(name, unit)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, entry):
+        return entry in self.rows
+
+    def _counts(self, text):
+        return Counter(char_ngrams(text, self.n_values))
+
+    def add(self, name, unit):
+        """添加一行，已存在时不变"""
+        entry = (name, unit)
+        if entry in self.rows:
+            return
+        counts = self._counts(name)
+        if self.free:
+            row = self.free.pop()
+        else:
+            row = len(self.entries)
+            self.entries.append(None)
+            self.norms.append(0.0)
+        for gram, count in counts.items():
+            self.postings.setdefault(gram, {})[row] = count
+        self.entries[row] = entry
+        self.norms[row] = math.sqrt(sum(c * c for c in counts.values())) or 1.0
+        self.rows[entry] = row
+
+    def remove(self, name, unit):
+        """删除一行，不存在时不变"""
+        row = self.rows.pop((name, unit), None)
+        if row is None:
+            return
+        for gram in self._counts(name):
+            postings = self.postings[gram]
+            del postings[row]
+            if not postings:
+                del self.postings[gram]
+        self.entries[row] = None
+        self.free.append(row)
+
+    def query(self, text, k=5, unit=None):
+        """返回与text最相似的k个条目
+
+        unit: 只在该单位的条目中查找
+        return: [((名称, 单位), 相似度), ...]，按相似度降序"""
+        counts = self._counts(text)
+        if not counts:
+            return []
+        # 查询中不在索引里的n-gram也计入范数，避免短查询得分虚高
+        norm = math.sqrt(sum(c * c for c in counts.values()))
+        dots = {}
+        for gram, count in counts.items():
+            for row, row_count in self.postings.get(gram, {}).items():
+                dots[row] = dots.get(row, 0) + count * row_count
+        matches = (
+            (self.entries[row], dot / (self.norms[row] * norm))
+            for row, dot in dots.items()
+            if unit is None or self.entries[row][1] == unit
+        )
+        return heapq.nlargest(k, matches, key=lambda match: match[1])
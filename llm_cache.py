@@ -0,0 +1,118 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.db")
+# 缓存有效期(秒)，默认30天
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(30 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+
+
+def normalize_key(*parts):
+    """规范化缓存键：全角转半角、去首尾空白、合并空白、小写"""
+    normalized = []
+    for part in parts:
+        text = unicodedata.normalize("NFKC", str(part or ""))
+        normalized.append(" ".join(text.split()).lower())
+    return "\x1f".join(normalized)
+
+
+class LLMCache:
+    """基于SQLite的LLM响应缓存，带TTL和按最近使用时间的容量淘汰"""
+
+    def __init__(
+        self,
+        db_path=LLM_CACHE_PATH,
+        ttl=LLM_CACHE_TTL,
+        max_entries=LLM_CACHE_MAX_ENTRIES,
+    ):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._create_tables()
+
+    def _create_tables(self):
+        """创建缓存表"""
+        with self.conn:
+            self.conn.execute(
+                """
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                kind TEXT,
+                key TEXT,
+                value TEXT,
+                created_at REAL,
+                last_used REAL,
+                PRIMARY KEY (kind, key)
+            )
+            """
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)"
+            )
+
+    def get(self, kind, key):
+        """读取缓存，未命中或已过期返回None"""
+        now = time.time()
+        with self.lock:
+            result = self.conn.execute(
+                "SELECT value, created_at FROM llm_cache WHERE kind=? AND key=?",
+                (kind, key),
+            ).fetchone()
+            if result and now - result[1] <= self.ttl:
+                with self.conn:
+                    self.conn.execute(
+                        "UPDATE llm_cache SET last_used=? WHERE kind=? AND key=?",
+                        (now, kind, key),
+                    )
+                self.hits += 1
+                return json.loads(result[0])
+            if result:
+                # 已过期
+                with self.conn:
+                    self.conn.execute(
+                        "DELETE FROM llm_cache WHERE kind=? AND key=?", (kind, key)
+                    )
+            self.misses += 1
+            return None
+
+    def set(self, kind, key, value):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO llm_cache
+                   (kind, key, value, created_at, last_used)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (kind, key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            (size,) = self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            if size > self.max_entries:
+                self.conn.execute(
+                    """DELETE FROM llm_cache WHERE rowid IN (
+                           SELECT rowid FROM llm_cache ORDER BY last_used LIMIT ?
+                       )""",
+                    (size - self.max_entries,),
+                )
+
+    def stats(self):
+        """return: {"hits", "misses", "hit_rate", "size"}"""
+        with self.lock:
+            (size,) = self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": size,
+            }
+
+    def close(self):
+        """关闭数据库连接"""
+        self.conn.close()
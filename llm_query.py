@@ -1,43 +1,107 @@
 import requests
 import json
 import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from FoodItem import FoodItem
+from llm_cache import LLMCache, LLM_CACHE_PATH, normalize_key
+from parse_input import convert_chinese_num
+from metrics import (
+    LLM_DURATION,
+    LLM_FOOD_ITEMS,
+    LLM_REQUESTS,
+    LLM_TOKENS,
+    STAGE_DURATION,
+)
+from rate_limiter import backoff_delay, parse_retry_after
 
 
-class LLMService:
-    def __init__(self):
-        load_dotenv()
-        self.LLM_API_KEY = os.getenv("LLM_API_KEY")
-        self.LLM_model = os.getenv("LLM_MODEL", "claude-3-5-haiku-20241022")
-        self.headers = {
-            "x-api-key": self.LLM_API_KEY,
-            "anthropic-version": "2023-06-01",
-            "Content-Type": "application/json",
-        }
+load_dotenv()
+# 可指向本地替身服务做测试
+LLM_API_URL = os.getenv("LLM_API_URL", "https://api.anthropic.com/v1/messages")
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "4096"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+# 单次query_llm(含重试)的总时限(秒)
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "120"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+# 进程内同时在途的LLM请求数上限
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+# 营养查询每次请求最多包含的食物数，越小并行度越高
+LLM_CHUNK_SIZE = int(os.getenv("LLM_CHUNK_SIZE", "5"))
 
-    def query_llm(self, prompt, temperature=0.1):
-        """使用LLM API查询"""
-        llm_url = "https://api.anthropic.com/v1/messages"
+# 429限流、5xx和529过载时重试
+LLM_RETRY_STATUS = {429, 500, 502, 503, 504, 529}
+# 提示词格式: compact(逐行"|"分隔) 或 legacy(原JSON模板)
+PROMPT_STYLE = os.getenv("LLM_PROMPT_STYLE", "compact")
+# 营养查询结果中每个食物约占的输出token数(按legacy格式估计)，以及JSON外层的开销
+NUTRITION_TOKENS_PER_ITEM = 80
+NUTRITION_OUTPUT_OVERHEAD = 50
 
-        payload = {
-            "model": self.LLM_model,  # 使用适当的模型
-            "max_tokens": 1000,
-            "temperature": temperature,
-            "messages": [{"role": "user", "content": prompt}],
-        }
+# 缓存中保存的FoodItem字段
+CACHED_FOOD_FIELDS = ("name", "calories", "unit", "protein", "fat", "carbs", "grams")
 
-        response = requests.post(llm_url, headers=self.headers, json=payload)
-        # print(f"LLM API响应: {response.text}")
-        if response.status_code == 200:
-            return response.json()["content"][0]["text"]
-        else:
-            print(f"LLM API调用失败: {response.status_code}")
-            return None
+_number_re = re.compile(r"-?\d+(?:\.\d+)?")
+# 行首的"1."、"2、"、"-"等序号
+_line_prefix_re = re.compile(r"^(?:\d+[.、)]|[-*•])\s*")
+# markdown表格的分隔行，如"|---|:--:|"
+_table_border_re = re.compile(r"^[\s:|-]*$")
 
-    def get_food_nutrition(self, food_items):
-        """return: [FoodItem, ...]"""
-        prompt = f"""
+_session = None
+_session_lock = threading.Lock()
+# 所有LLMService实例共享的并发名额
+_llm_slots = threading.BoundedSemaphore(LLM_CONCURRENCY)
+
+
+def get_session():
+    """返回所有LLM调用共享的keep-alive会话"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=LLM_CONCURRENCY)
+            session.mount(LLM_API_URL, adapter)
+            _session = session
+    return _session
+
+
+def chunk_food_items(food_items, max_tokens=LLM_MAX_TOKENS, chunk_size=LLM_CHUNK_SIZE):
+    """把食物列表切成多段，每段的结果不超过max_tokens输出预算"""
+    budget = (max_tokens - NUTRITION_OUTPUT_OVERHEAD) // NUTRITION_TOKENS_PER_ITEM
+    size = max(1, min(chunk_size, budget))
+    return [food_items[i : i + size] for i in range(0, len(food_items), size)]
+
+
+def llm_retry_delay(response, attempt):
+    """return: 可重试的响应需要等待的秒数，不可重试时返回None"""
+    if response.status_code not in LLM_RETRY_STATUS:
+        return None
+    retry_after = parse_retry_after(response.headers.get("retry-after"))
+    return retry_after or backoff_delay(attempt)
+
+
+def record_usage(data, method, elapsed):
+    """记录一次成功调用的输入/输出token数和耗时"""
+    usage = data.get("usage") or {}
+    LLM_TOKENS.inc(usage.get("input_tokens", 0), method=method, type="input")
+    LLM_TOKENS.inc(usage.get("output_tokens", 0), method=method, type="output")
+    LLM_DURATION.observe(elapsed, method=method)
+
+
+def response_text(data):
+    """提取回复文本，输出因max_tokens被截断时给出提示"""
+    if data.get("stop_reason") == "max_tokens":
+        print("LLM输出达到max_tokens被截断，可调大LLM_MAX_TOKENS或减小LLM_CHUNK_SIZE")
+    return data["content"][0]["text"]
+
+
+# 以下为原先的JSON模板提示词，LLM_PROMPT_STYLE=legacy时使用
+def _legacy_nutrition_prompt(food_items):
+    return f"""
         请根据以下食物名称和单位，返回每种食物的营养信息。
         {food_items}
         如果单位为"克"，则给出每克的热量。
@@ -69,32 +133,33 @@ class LLMService:
 
         确保返回的是一个有效的JSON对象，所有数值应该是数字而非字符串。
         """
-        result_text = LLMService().query_llm(prompt)
-        try:
-            food_nutrition = json.loads(result_text)
-            food_nutrition_items = food_nutrition.get("items", [])
-            food_nutrition_list = []
-            for item in food_nutrition_items:
-                food_item = FoodItem(
-                    name=item.get("name"),
-                    calories=item.get("calories"),
-                    unit=item.get("unit"),
-                    protein=item.get("protein"),
-                    fat=item.get("fat"),
-                    carbs=item.get("carbs"),
-                    grams=item.get("grams") if item.get("unit") != "克" else 1,
-                )
-                food_nutrition_list.append(food_item)
-            return food_nutrition_list
 
-        except json.JSONDecodeError:
-            print(f"解析JSON失败: {result_text}")
-            return None
 
-    def get_name_quantity_unit(self, food_description):
-        """return: [(食物名称, 数量, 单位), ...]"""
-        food_items = []
-        prompt = f"""
+def _parse_legacy_nutrition(result_text):
+    try:
+        food_nutrition = extract_json(result_text)
+        food_nutrition_items = food_nutrition.get("items", [])
+        food_nutrition_list = []
+        for item in food_nutrition_items:
+            food_item = FoodItem(
+                name=item.get("name"),
+                calories=item.get("calories"),
+                unit=item.get("unit"),
+                protein=item.get("protein"),
+                fat=item.get("fat"),
+                carbs=item.get("carbs"),
+                grams=item.get("grams") if item.get("unit") != "克" else 1,
+            )
+            food_nutrition_list.append(food_item)
+        return food_nutrition_list
+
+    except json.JSONDecodeError:
+        print(f"解析JSON失败: {result_text}")
+        return None
+
+
+def _legacy_name_quantity_unit_prompt(food_description):
+    return f"""
             请根据以下食物描述提取食物名称、数量和单位，返回JSON格式的结果：
             {food_description}
 
@@ -118,19 +183,344 @@ class LLMService:
             若无法确定unit，请返回"个"
             """
 
-        result_text = LLMService().query_llm(prompt)
+
+def _parse_legacy_name_quantity_unit(result_text):
+    food_items = []
+    try:
+        food_data = extract_json(result_text)
+        items = food_data.get("items", [])
+        for item in items:
+            name = item.get("name")
+            quantity = item.get("quantity", 1)
+            unit = item.get("unit", "个")
+            food_items.append((name, quantity, unit))
+        return food_items
+    except json.JSONDecodeError:
+        print(f"解析JSON失败: {result_text}")
+        return None
+
+
+def extract_json(text):
+    """从回复中取出第一个{到最后一个}之间的JSON对象，容忍前后的说明文字和代码块标记"""
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end < start:
+        raise json.JSONDecodeError("未找到JSON对象", text, 0)
+    return json.loads(text[start : end + 1])
+
+
+def _number(text):
+    """从"232kcal"、"约4.5"等字段中取出数值，没有数字时返回None"""
+    match = _number_re.search(text)
+    if not match:
+        return None
+    value = float(match.group())
+    return int(value) if value.is_integer() else value
+
+
+def _split_fields(line):
+    """拆分"名称|单位|..."格式的一行，去掉序号和表格边框
+
+    return: 字段列表；表格分隔行和回显的表头行返回[]"""
+    if _table_border_re.match(line):
+        return []
+    line = _line_prefix_re.sub("", line.strip().strip("|"))
+    fields = [field.strip() for field in line.split("|")]
+    if fields[0] == "名称":
+        return []
+    return fields
+
+
+def _compact_nutrition_prompt(food_items):
+    lines = "\n".join(
+        f"{food.get('food_name')}|{food.get('unit')}" for food in food_items
+    )
+    return (
+        "逐行给出下列食物(名称|单位)的营养，按输入顺序每行输出一个:\n"
+        "名称|单位|每单位热量kcal|蛋白质g|脂肪g|碳水g|每单位克数\n"
+        '单位为"克"时按每克计算；名称形如"咖啡:300卡"时用给定热量。只输出数据行。\n'
+        f"{lines}"
+    )
+
+
+def _parse_compact_nutrition(result_text):
+    food_nutrition_list = []
+    for line in result_text.splitlines():
+        fields = _split_fields(line)
+        if len(fields) < 7:
+            continue
+        numbers = [_number(field) for field in fields[2:7]]
+        if None in numbers:
+            continue
+        calories, protein, fat, carbs, grams = numbers
+        food_nutrition_list.append(
+            FoodItem(
+                name=fields[0],
+                calories=calories,
+                unit=fields[1],
+                protein=protein,
+                fat=fat,
+                carbs=carbs,
+                grams=grams if fields[1] != "克" else 1,
+            )
+        )
+    if not food_nutrition_list:
+        print(f"解析营养结果失败: {result_text}")
+        return None
+    return food_nutrition_list
+
+
+def _compact_name_quantity_unit_prompt(food_description):
+    return (
+        "把饮食描述拆成食物，每行输出: 名称|数量|单位\n"
+        '名称去掉数量词、保留修饰语(如"一个去皮的鸡腿"→去皮的鸡腿|1|个)；'
+        "数量不确定写1，单位不确定写个。只输出数据行。\n"
+        f"描述: {food_description}"
+    )
+
+
+def _parse_compact_name_quantity_unit(result_text):
+    food_items = []
+    for line in result_text.splitlines():
+        fields = _split_fields(line)
+        if len(fields) < 2 or not fields[0]:
+            continue
+        # 与营养结果一样要求数值字段，说明文字等非数据行跳过
+        quantity = _number(fields[1])
+        if quantity is None:
+            quantity = convert_chinese_num(fields[1])
+        if quantity is None:
+            continue
+        unit = fields[2] if len(fields) > 2 and fields[2] else "个"
+        food_items.append((fields[0], quantity, unit))
+    if not food_items:
+        print(f"解析食物描述结果失败: {result_text}")
+        return None
+    return food_items
+
+
+def nutrition_prompt(food_items, style=PROMPT_STYLE):
+    """food_items: [{"food_name": 名称, "unit": 单位}, ...]"""
+    if style == "legacy":
+        return _legacy_nutrition_prompt(food_items)
+    return _compact_nutrition_prompt(food_items)
+
+
+def parse_nutrition_result(result_text, style=PROMPT_STYLE):
+    """return: [FoodItem, ...]，无法解析时返回None"""
+    if style == "legacy":
+        return _parse_legacy_nutrition(result_text)
+    return _parse_compact_nutrition(result_text)
+
+
+def name_quantity_unit_prompt(food_description, style=PROMPT_STYLE):
+    if style == "legacy":
+        return _legacy_name_quantity_unit_prompt(food_description)
+    return _compact_name_quantity_unit_prompt(food_description)
+
+
+def parse_name_quantity_unit_result(result_text, style=PROMPT_STYLE):
+    """return: [(食物名称, 数量, 单位), ...]，无法解析时返回None"""
+    if not result_text:
+        return None
+    if style == "legacy":
+        return _parse_legacy_name_quantity_unit(result_text)
+    return _parse_compact_name_quantity_unit(result_text)
+
+
+def align_nutrition_result(chunk, result_text, style=PROMPT_STYLE):
+    """解析一段营养查询的结果，无法按位置对应请求时全部返回None"""
+    llm_items = parse_nutrition_result(result_text, style) if result_text else None
+    if llm_items is None:
+        return [None] * len(chunk)
+    if len(llm_items) != len(chunk):
+        print(f"LLM返回数量不匹配: 请求{len(chunk)}个, 返回{len(llm_items)}个")
+        return [None] * len(chunk)
+    return llm_items
+
+
+class LLMService:
+    def __init__(
+        self,
+        cache=None,
+        session=None,
+        max_tokens=LLM_MAX_TOKENS,
+        prompt_style=PROMPT_STYLE,
+    ):
+        """cache: LLMCache实例；默认使用LLM_CACHE_PATH，为空字符串时不缓存
+        session: 复用的requests会话，默认使用共享连接池
+        prompt_style: compact或legacy，见PROMPT_STYLE"""
+        if cache is None and LLM_CACHE_PATH:
+            cache = LLMCache()
+        self.cache = cache
+        self.session = session or get_session()
+        self.max_tokens = max_tokens
+        self.prompt_style = prompt_style
+        self.LLM_API_KEY = os.getenv("LLM_API_KEY")
+        self.LLM_model = os.getenv("LLM_MODEL", "claude-3-5-haiku-20241022")
+        self.llm_url = LLM_API_URL
+        self.headers = {
+            "x-api-key": self.LLM_API_KEY,
+            "anthropic-version": "2023-06-01",
+            "Content-Type": "application/json",
+        }
+
+    def query_llm(self, prompt, temperature=0.1, method="query"):
+        """使用LLM API查询
+
+        连接错误、超时以及LLM_RETRY_STATUS中的状态码会退避重试，
+        总耗时不超过LLM_DEADLINE。
+        method: 调用用途(nutrition/parse)，用于指标标签"""
+        payload = self._payload(prompt, temperature)
+
+        started = time.monotonic()
+        deadline = started + LLM_DEADLINE
+        with STAGE_DURATION.time(stage="llm"):
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                last_attempt = attempt == LLM_MAX_RETRIES
+                remaining = deadline - time.monotonic()
+                timeout = (
+                    LLM_CONNECT_TIMEOUT,
+                    max(1.0, min(LLM_READ_TIMEOUT, remaining)),
+                )
+                try:
+                    with _llm_slots:
+                        response = self.session.post(
+                            self.llm_url,
+                            headers=self.headers,
+                            json=payload,
+                            timeout=timeout,
+                        )
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    LLM_REQUESTS.inc(method=method, status="error")
+                    delay = backoff_delay(attempt)
+                    if last_attempt or time.monotonic() + delay >= deadline:
+                        raise
+                    print(f"LLM请求异常，准备重试: {e}")
+                    time.sleep(delay)
+                    continue
+                LLM_REQUESTS.inc(method=method, status=response.status_code)
+                delay = llm_retry_delay(response, attempt)
+                if (
+                    delay is None
+                    or last_attempt
+                    or time.monotonic() + delay >= deadline
+                ):
+                    break
+                print(f"LLM API返回{response.status_code}，{delay:.1f}秒后重试")
+                time.sleep(delay)
+        # print(f"LLM API响应: {response.text}")
+        if response.status_code == 200:
+            data = response.json()
+            record_usage(data, method, time.monotonic() - started)
+            return response_text(data)
+        else:
+            print(f"LLM API调用失败: {response.status_code}")
+            return None
+
+    def _payload(self, prompt, temperature):
+        return {
+            "model": self.LLM_model,  # 使用适当的模型
+            "max_tokens": self.max_tokens,
+            "temperature": temperature,
+            "messages": [{"role": "user", "content": prompt}],
+        }
+
+    def get_food_nutrition(self, food_items):
+        """按(名称, 单位)查询营养信息，命中缓存的不再请求LLM
+
+        food_items: [{"food_name": 名称, "unit": 单位}, ...]
+        return: [FoodItem, ...]，与输入顺序一致，查询失败的位置为None"""
+        results, misses = self._cached_nutrition(food_items)
+        if not misses:
+            return results
+        llm_items = self._query_food_nutrition([food for _, _, food in misses])
+        return self._merge_nutrition(results, misses, llm_items)
+
+    def _cached_nutrition(self, food_items):
+        """return: (按输入顺序的结果，未命中处为None, [(位置, 缓存键, 食物), ...])"""
+        results = [None] * len(food_items)
+        misses = []
+        for i, food in enumerate(food_items):
+            key = normalize_key(food.get("food_name"), food.get("unit"))
+            cached = self.cache.get("nutrition", key) if self.cache else None
+            if cached:
+                results[i] = FoodItem(**cached)
+            else:
+                misses.append((i, key, food))
+        return results, misses
+
+    def _merge_nutrition(self, results, misses, llm_items):
+        """把LLM结果填回未命中的位置并写入缓存
+
+        llm_items: 与misses一一对应，查询失败的位置为None"""
+        for (i, key, _), food_item in zip(misses, llm_items):
+            if food_item is None:
+                continue
+            results[i] = food_item
+            if self.cache:
+                self.cache.set(
+                    "nutrition",
+                    key,
+                    {field: getattr(food_item, field) for field in CACHED_FOOD_FIELDS},
+                )
+        return results
+
+    def _query_food_nutrition(self, food_items):
+        """按输出预算分段并行向LLM查询营养信息，结果按输入顺序合并
+
+        return: [FoodItem or None, ...]，与food_items一一对应"""
+        chunks = chunk_food_items(food_items, self.max_tokens)
+        if len(chunks) == 1:
+            return self._query_nutrition_chunk(chunks[0])
+        with ThreadPoolExecutor(max_workers=min(LLM_CONCURRENCY, len(chunks))) as pool:
+            chunk_results = list(pool.map(self._query_nutrition_chunk, chunks))
+        return [food_item for chunk in chunk_results for food_item in chunk]
+
+    def _query_nutrition_chunk(self, chunk):
+        """return: 与chunk一一对应的[FoodItem, ...]；失败或数量不匹配时全部为None"""
         try:
-            food_data = json.loads(result_text)
-            items = food_data.get("items", [])
-            for item in items:
-                name = item.get("name")
-                quantity = item.get("quantity", 1)
-                unit = item.get("unit", "个")
-                food_items.append((name, quantity, unit))
-            return food_items
-        except json.JSONDecodeError:
-            print(f"解析JSON失败: {result_text}")
+            LLM_FOOD_ITEMS.inc(len(chunk))
+            result_text = self.query_llm(
+                nutrition_prompt(chunk, self.prompt_style), method="nutrition"
+            )
+        except requests.RequestException as e:
+            print(f"LLM请求失败: {e}")
+            return [None] * len(chunk)
+        return align_nutrition_result(chunk, result_text, self.prompt_style)
+
+    def get_name_quantity_unit(self, food_description):
+        """return: [(食物名称, 数量, 单位), ...]"""
+        cached = self._cached_parse(food_description)
+        if cached:
+            return cached
+        food_items = self._query_name_quantity_unit(food_description)
+        self._store_parse(food_description, food_items)
+        return food_items
+
+    def _cached_parse(self, food_description):
+        if not self.cache:
             return None
+        cached = self.cache.get("parse", normalize_key(food_description))
+        return [tuple(item) for item in cached] if cached else None
+
+    def _store_parse(self, food_description, food_items):
+        if food_items and self.cache:
+            self.cache.set(
+                "parse",
+                normalize_key(food_description),
+                [list(item) for item in food_items],
+            )
+
+    def _query_name_quantity_unit(self, food_description):
+        """向LLM解析食物描述
+
+        return: [(食物名称, 数量, 单位), ...]"""
+        result_text = self.query_llm(
+            name_quantity_unit_prompt(food_description, self.prompt_style),
+            method="parse",
+        )
+        return parse_name_quantity_unit_result(result_text, self.prompt_style)
 
         # def parse_multiple_food(self, food_description, get_nutrition=True):
         """解析多个食物描述，返回食物名称、数量和单位的列表
@@ -168,7 +558,7 @@ class LLMService:
 
             确保返回的是一个有效的JSON对象，所有数值应该是数字而非字符串。
             """
-            result_text = LLMService().query_llm(prompt)
+            result_text = self.query_llm(prompt)
 
             try:
                 food_nutrition = json.loads(result_text)
@@ -204,7 +594,25 @@ if __name__ == "__main__":
     #     print(f"碳水化合物: {food_item.carbs}克")
     # else:
     #     print("未能获取食物信息")
-    # food_description = "10个鸡块，两个巨无霸，三碗卤肉饭,一个去皮的鸡腿"
-    food_description = "两个巨无霸"
-    food_items, nut_l = llm_service.parse_multiple_food(food_description)
-    print(f"解析结果: {food_items, nut_l}")
+    # 回复解析的回归用例，不访问LLM: python llm_query.py
+    replies = {
+        "鸡腿|1|个": [("鸡腿", 1, "个")],
+        "名称|数量|单位\n鸡腿|1|个": [("鸡腿", 1, "个")],
+        "| 名称 | 数量 | 单位 |\n|---|:---:|---|\n| 米饭 | 2 | 碗 |\n| 鸡腿 | 1 | 个 |": [
+            ("米饭", 2, "碗"),
+            ("鸡腿", 1, "个"),
+        ],
+        "1. 米饭|2|碗\n- 鸡腿|约1|个": [("米饭", 2, "碗"), ("鸡腿", 1, "个")],
+        "好的，结果如下:\n米饭|两|碗": [("米饭", 2, "碗")],
+        "说明|无|无": None,
+    }
+    for reply, expected in replies.items():
+        result = _parse_compact_name_quantity_unit(reply)
+        assert result == expected, (reply, result)
+    nutrition = _parse_compact_nutrition(
+        "名称|单位|每单位热量kcal|蛋白质g|脂肪g|碳水g|每单位克数\n"
+        "|---|---|---|---|---|---|---|\n"
+        "米饭|碗|232|4.5|0.5|51|200"
+    )
+    assert [(item.name, item.calories) for item in nutrition] == [("米饭", 232)]
+    print(f"{len(replies) + 1} 个用例通过")
@@ -0,0 +1,215 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "8000"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    """只增计数器，按标签分组"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            return self.values.get(key, 0)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Gauge:
+    """可增可减的当前值，按标签分组"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            return self.values.get(key, 0)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+        ]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Histogram:
+    """累积分桶直方图，按标签分组"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            if key not in self.values:
+                # [各桶计数, 总和, 总次数]
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """记录with块的耗时(秒)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(self.labelnames, key, [("le", bound)])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _format_labels(self.labelnames, key, [("le", "+Inf")])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render_metrics():
+    """Prometheus文本格式"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+ENTRIES_PROCESSED = Counter(
+    "food_entries_processed_total", "处理的主数据库条目数", ["status"]
+)
+PARSE_TOTAL = Counter(
+    "food_parse_total", "食物描述解析次数，按规则解析/LLM回退区分", ["source"]
+)
+LOCAL_LOOKUPS = Counter("food_local_lookups_total", "本地食物库查询次数", ["result"])
+REFERENCE_LOOKUPS = Counter(
+    "food_reference_lookups_total", "本地未命中后营养参考库查询次数", ["result"]
+)
+NOTION_REQUESTS = Counter(
+    "notion_requests_total", "Notion API请求数", ["method", "status"]
+)
+LLM_REQUESTS = Counter("llm_requests_total", "LLM API请求数", ["method", "status"])
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "LLM成功调用的token数，按输入/输出区分", ["method", "type"]
+)
+LLM_FOOD_ITEMS = Counter("llm_food_items_total", "营养查询请求的食物数")
+LLM_DURATION = Histogram(
+    "llm_call_duration_seconds", "成功的LLM调用耗时(含重试)", ["method"]
+)
+WORK_QUEUE_JOBS = Counter(
+    "work_queue_jobs_total",
+    "条目队列事件: enqueued, leased, released, acked, failed, dead",
+    ["event"],
+)
+WORK_QUEUE_DEPTH = Gauge("work_queue_depth", "条目队列中各状态的任务数", ["state"])
+WORK_QUEUE_OLDEST_AGE = Gauge(
+    "work_queue_oldest_age_seconds", "最早入队且未完成的任务已等待的秒数"
+)
+CACHE_HIT_RATE = Gauge(
+    "food_cache_hit_rate", "进程启动以来的缓存命中率: local, llm", ["cache"]
+)
+CACHE_SIZE = Gauge("food_cache_size", "缓存中的条目数: local, llm", ["cache"])
+STAGE_DURATION = Histogram(
+    "food_stage_duration_seconds",
+    "各处理阶段耗时: parse, lookup, llm, notion_write, sync",
+    ["stage"],
+)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 不把每次抓取写进日志
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT, handler=MetricsHandler, host="0.0.0.0"):
+    """在后台线程启动指标HTTP服务，返回server对象"""
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
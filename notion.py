@@ -1,16 +1,34 @@
 import os
 import json
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
 
 
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from FoodItem import FoodItem
+from metrics import NOTION_REQUESTS, STAGE_DURATION
+from rate_limiter import TokenBucket, backoff_delay, parse_retry_after
 
 
 load_dotenv()
 NOTION_TOKEN = os.getenv("NOTION_TOKEN")
 NOTION_MAIN_DATABASE_ID = os.getenv("NOTION_MAIN_DATABASE_ID")
 NOTION_FOOD_DATABASE_ID = os.getenv("NOTION_FOOD_DATABASE_ID")
+# 可指向本地替身服务做测试
+NOTION_API_URL = os.getenv("NOTION_API_URL", "https://api.notion.com/v1").rstrip("/")
+
+# 连接池配置
+NOTION_POOL_SIZE = int(os.getenv("NOTION_POOL_SIZE", "10"))
+NOTION_CONNECT_TIMEOUT = float(os.getenv("NOTION_CONNECT_TIMEOUT", "5"))
+NOTION_READ_TIMEOUT = float(os.getenv("NOTION_READ_TIMEOUT", "30"))
+
+# 限流与重试配置(Notion每个集成约3次/秒)
+NOTION_RATE_LIMIT = float(os.getenv("NOTION_RATE_LIMIT", "3"))
+NOTION_MAX_RETRIES = int(os.getenv("NOTION_MAX_RETRIES", "5"))
 
 
 notion_headers = {
@@ -19,130 +37,397 @@ notion_headers = {
     "Notion-Version": "2022-06-28",  # 使用最新版本
 }
 
+_session = None
+_session_lock = threading.Lock()
 
-class Notion:
-    def __init__(self):
-        self.main_database_id = NOTION_MAIN_DATABASE_ID
-        self.food_database_id = NOTION_FOOD_DATABASE_ID
+# 所有Notion调用共享的限流器
+rate_limiter = TokenBucket(NOTION_RATE_LIMIT)
 
-    def get_all_entries(self):
-        url = f"https://api.notion.com/v1/databases/{self.main_database_id}/query"
+# 各线程自己发出的请求数，并发处理条目时按条目统计不会混入其他线程的请求
+_thread_stats = threading.local()
 
-        payload = {
-            "filter": {
-                "property": "食物描述",
-                "rich_text": {
-                    "is_not_empty": True,
+
+def get_session():
+    """返回所有Notion调用共享的keep-alive会话(连接池)"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=NOTION_POOL_SIZE,
+                pool_block=True,
+            )
+            session.mount(NOTION_API_URL, adapter)
+            session.headers.update(notion_headers)
+            _session = session
+    return _session
+
+
+def connection_stats():
+    """返回共享连接池中已建立的连接数和已发出的请求数
+
+    return: {"connections": int, "requests": int}"""
+    adapter = get_session().get_adapter(NOTION_API_URL)
+    pools = adapter.poolmanager.pools
+    stats = {"connections": 0, "requests": 0}
+    for key in pools.keys():
+        pool = pools[key]
+        stats["connections"] += pool.num_connections
+        stats["requests"] += pool.num_requests
+    return stats
+
+
+def thread_request_count():
+    """当前线程累计发出的Notion请求数(含重试)"""
+    return getattr(_thread_stats, "requests", 0)
+
+
+# 各查询的请求体，同步和异步客户端共用
+ALL_ENTRIES_QUERY = {
+    "filter": {
+        "property": "食物描述",
+        "rich_text": {
+            "is_not_empty": True,
+        },
+    }
+}
+PENDING_ENTRIES_QUERY = {
+    "filter": {
+        "or": [
+            {"property": "状态", "select": {"does_not_equal": "已完成"}},
+            {
+                "property": "食物",
+                "relation": {"is_empty": True},
+            },
+        ],
+    }
+}
+ALL_FOOD_QUERY = {
+    "filter": {
+        "property": "名称",
+        "rich_text": {
+            "is_not_empty": True,
+        },
+    }
+}
+UPDATE_FOOD_QUERY = {"filter": {"property": "状态", "select": {"equals": "异常"}}}
+
+
+def edited_since_query(last_edited_time):
+    """last_edited_time不早于给定时间的食物，按编辑时间升序"""
+    return {
+        "filter": {
+            "and": [
+                {"property": "名称", "rich_text": {"is_not_empty": True}},
+                {
+                    "timestamp": "last_edited_time",
+                    "last_edited_time": {"on_or_after": last_edited_time},
                 },
-            }
+            ]
+        },
+        "sorts": [{"timestamp": "last_edited_time", "direction": "ascending"}],
+    }
+
+
+def food_lookup_query(food_name, unit, calories=None):
+    return {
+        "filter": {
+            "and": [
+                {"property": "名称", "title": {"equals": food_name}},
+                {"property": "单位", "select": {"equals": unit}},
+                {"property": "热量", "number": {"equals": calories}},
+            ]
         }
-        response = requests.post(url, headers=notion_headers, json=payload)
-        if response.status_code == 200:
-            return response.json()["results"]
+    }
+
+
+def new_food_page(database_id, food_item: FoodItem):
+    """创建食物页面的请求体"""
+    return {
+        "parent": {"database_id": database_id},
+        "properties": {
+            "名称": {
+                "title": [{"text": {"content": food_item.name}}],
+            },
+            "热量": {
+                "number": food_item.calories,
+            },
+            "单位": {
+                "select": {"name": food_item.unit},
+            },
+            "蛋白质": {
+                "number": food_item.protein,
+            },
+            "脂肪": {
+                "number": food_item.fat,
+            },
+            "碳水": {
+                "number": food_item.carbs,
+            },
+            "大致克数": {
+                "number": food_item.grams,
+            },
+            "状态": {
+                "select": {"name": "正常"},
+            },
+        },
+    }
+
+
+def is_read_request(method, url):
+    return method == "GET" or url.endswith("/query")
+
+
+def is_idempotent_request(method, url):
+    """查询(/query)、GET、PATCH、DELETE视为幂等，创建页面不是"""
+    return method != "POST" or url.endswith("/query")
+
+
+def retry_delay(response, idempotent, attempt):
+    """根据响应更新共享限流器，并决定是否重试
+
+    429一律重试(请求未被处理，等待由限流器负责)；5xx只对幂等请求重试。
+    return: 重试前需要额外等待的秒数，不重试时返回None"""
+    if response.status_code == 429:
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        delay = retry_after or backoff_delay(attempt)
+        rate_limiter.on_throttled(delay)
+        print(f"Notion限流，{delay:.1f}秒后重试")
+        return 0
+    if response.status_code >= 500:
+        rate_limiter.on_throttled()
+        if idempotent:
+            delay = backoff_delay(attempt)
+            print(f"Notion服务错误 {response.status_code}，{delay:.1f}秒后重试")
+            return delay
+        return None
+    rate_limiter.on_success()
+    return None
+
+
+def entry_description(entry):
+    """主数据库条目页面的食物描述文本"""
+    return entry["properties"]["食物描述"]["rich_text"][0]["text"]["content"]
+
+
+def entry_foods(entry):
+    """主数据库条目页面关联的食物ID和数量
+
+    return: ([notion_id, ...], [数量, ...])；页面缺少这两项时抛出KeyError/IndexError/ValueError"""
+    properties = entry["properties"]
+    quantities = json.loads(properties["数量"]["rich_text"][0]["text"]["content"])
+    notion_ids = [relation["id"] for relation in properties["食物"]["relation"]]
+    return notion_ids, quantities
+
+
+def notion_timestamp(value):
+    """Notion的ISO 8601时间(如created_time) -> Unix时间戳，空值返回None"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+class EntryUpdate:
+    """收集主数据库条目的属性修改，通过Notion.commit_entry一次PATCH写入"""
 
-    def get_pending_entries(self):
-        """从Notion获取所有非'已完成'状态的条目"""
-        url = f"https://api.notion.com/v1/databases/{self.main_database_id}/query"
-        payload = {
-            "filter": {
-                "or": [
-                    {"property": "状态", "select": {"does_not_equal": "已完成"}},
-                    {
-                        "property": "食物",
-                        "relation": {"is_empty": True},
-                    },
-                ],
-            }
+    def __init__(self):
+        self.properties = {}
+
+    def relations(self, food_items):
+        """关联的食物(需已有notion_id，见Notion.ensure_food_ids)"""
+        self.properties["食物"] = {
+            "relation": [{"id": food_item.notion_id} for food_item in food_items]
         }
-        response = requests.post(url, headers=notion_headers, json=payload)
-        if response.status_code == 200:
-            return response.json()["results"]
-        else:
-            print(f"获取Notion条目失败: {response.status_code}")
-            print(response.json())
+        return self
 
-    def update_main_database(self, entry_id, food_items=[], quantities=[]):
-        url = f"https://api.notion.com/v1/pages/{entry_id}"
+    def totals(self, food_items, quantities):
+        """总热量和各食物数量"""
         total_calories = 0
         for i, food_item in enumerate(food_items):
             total_calories += food_item.calories * quantities[i]
-        payload = {
-            "properties": {
-                "总热量": {
-                    "number": total_calories,
-                },
-                "状态": {"select": {"name": "已完成"}},
-                "数量": {"rich_text": [{"text": {"content": json.dumps(quantities)}}]},
-            }
+        self.properties["总热量"] = {"number": total_calories}
+        self.properties["数量"] = {
+            "rich_text": [{"text": {"content": json.dumps(quantities)}}]
         }
-        response = requests.patch(url, headers=notion_headers, json=payload)
-        if response.status_code == 200:
+        return self
+
+    def status(self, status):
+        self.properties["状态"] = {"select": {"name": status}}
+        return self
+
+    def elapsed(self, seconds):
+        """处理用时(秒)，写入'更新用时'"""
+        self.properties["更新用时"] = {"number": seconds}
+        return self
+
+    def payload(self):
+        return {"properties": self.properties}
 
-            return True
-        if response.status_code != 200:
-            print(f"更新Notion条目失败: {response.status_code}")
-            print(response.json())
 
+class Notion:
+    def __init__(self, session=None, timeout=None):
+        self.main_database_id = NOTION_MAIN_DATABASE_ID
+        self.food_database_id = NOTION_FOOD_DATABASE_ID
+        self.session = session or get_session()
+        self.timeout = timeout or (NOTION_CONNECT_TIMEOUT, NOTION_READ_TIMEOUT)
+
+    def _request(self, method, url, idempotent=None, **kwargs):
+        """通过共享连接池和限流器发送请求
+
+        429一律按Retry-After重试(请求未被处理)；5xx和连接错误只对幂等请求
+        重试，见is_idempotent_request。
+        写请求的总耗时(含重试)记入notion_write阶段。"""
+        if is_read_request(method, url):
+            stage = nullcontext()
+        else:
+            stage = STAGE_DURATION.time(stage="notion_write")
+        with stage:
+            return self._send(method, url, idempotent, **kwargs)
+
+    def _send(self, method, url, idempotent, **kwargs):
+        if idempotent is None:
+            idempotent = is_idempotent_request(method, url)
+        kwargs.setdefault("headers", notion_headers)
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(NOTION_MAX_RETRIES + 1):
+            last_attempt = attempt == NOTION_MAX_RETRIES
+            rate_limiter.acquire()
+            _thread_stats.requests = thread_request_count() + 1
             try:
-                payload = {"properties": {"状态": {"select": {"name": "出错"}}}}
-                response = requests.patch(url, headers=notion_headers, json=payload)
-                if response.status_code != 200:
-                    print(f"更新Notion条目状态失败: {response.status_code}")
-            except Exception as e:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                NOTION_REQUESTS.inc(method=method, status="error")
+                if not idempotent or last_attempt:
+                    raise
+                print(f"Notion请求异常，准备重试: {e}")
+                time.sleep(backoff_delay(attempt))
+                continue
+            NOTION_REQUESTS.inc(method=method, status=response.status_code)
+            delay = retry_delay(response, idempotent, attempt)
+            if delay is None or last_attempt:
+                return response
+            time.sleep(delay)
+        return response
+
+    def query_database(self, database_id, payload=None, page_size=100):
+        """按游标分页查询数据库，逐条产出页面对象
+
+        每次只在内存中保留一页结果；请求失败时抛出requests.HTTPError，
+        避免调用方把不完整的结果当成完整数据库。"""
+        url = f"{NOTION_API_URL}/databases/{database_id}/query"
+        body = dict(payload or {})
+        body["page_size"] = page_size
+        while True:
+            response = self._request("POST", url, json=body)
+            if response.status_code != 200:
+                print(f"查询Notion数据库失败: {response.status_code}")
+                print(response.text)
+                response.raise_for_status()
+            data = response.json()
+            yield from data["results"]
+            if not data.get("has_more") or not data.get("next_cursor"):
+                return
+            body["start_cursor"] = data["next_cursor"]
+
+    @staticmethod
+    def parse_food_item(result):
+        """将食物数据库的页面对象转换为FoodItem"""
+        food_item = FoodItem(
+            name=result["properties"]["名称"]["title"][0]["text"]["content"],
+            calories=result["properties"]["热量"]["number"],
+            unit=result["properties"]["单位"]["select"]["name"],
+            protein=result["properties"]["蛋白质"]["number"],
+            fat=result["properties"]["脂肪"]["number"],
+            carbs=result["properties"]["碳水"]["number"],
+            grams=result["properties"]["大致克数"]["number"],
+        )
+        food_item.notion_id = result["id"]
+        food_item.last_edited_time = result.get("last_edited_time")
+        return food_item
+
+    def iter_food_items(self, payload=None):
+        """逐条产出食物数据库中的FoodItem"""
+        for result in self.query_database(self.food_database_id, payload):
+            yield self.parse_food_item(result)
+
+    def iter_all_entries(self):
+        """逐条产出主数据库中有食物描述的条目"""
+        return self.query_database(self.main_database_id, ALL_ENTRIES_QUERY)
+
+    def iter_pending_entries(self):
+        """逐条产出所有非'已完成'状态的条目"""
+        return self.query_database(self.main_database_id, PENDING_ENTRIES_QUERY)
+
+    def iter_all_food_items(self):
+        """逐条产出食物数据库中所有有名称的食物"""
+        return self.iter_food_items(ALL_FOOD_QUERY)
+
+    def iter_update_food(self):
+        """逐条产出状态为'异常'的食物"""
+        return self.iter_food_items(UPDATE_FOOD_QUERY)
+
+    def iter_food_items_edited_since(self, last_edited_time):
+        """逐条产出last_edited_time不早于给定时间的食物(含该时间点)
+
+        Notion的last_edited_time精确到分钟，所以用on_or_after并允许重复。"""
+        return self.iter_food_items(edited_since_query(last_edited_time))
+
+    def get_all_entries(self):
+        try:
+            return list(self.iter_all_entries())
+        except requests.RequestException:
+            return None
 
-                print(f"更新Notion条目状态失败: {e}")
-                return False
+    def get_pending_entries(self):
+        """从Notion获取所有非'已完成'状态的条目"""
+        try:
+            return list(self.iter_pending_entries())
+        except requests.RequestException as e:
+            print(f"获取Notion条目失败: {e}")
+            return None
 
-    def update_time(self, entry_id, update_time):
-        url = f"https://api.notion.com/v1/pages/{entry_id}"
-        payload = {
-            "properties": {
-                "更新用时": {
-                    "number": update_time,
-                },
-            }
-        }
-        response = requests.patch(url, headers=notion_headers, json=payload)
+    def commit_entry(self, entry_id, update: EntryUpdate):
+        """一次PATCH写入EntryUpdate收集的全部属性
+
+        return: 更新后的页面对象(含新的last_edited_time)，失败时返回None"""
+        url = f"{NOTION_API_URL}/pages/{entry_id}"
+        response = self._request("PATCH", url, json=update.payload())
+        if response.status_code == 200:
+            return response.json()
+        else:
+            print(f"更新Notion条目失败: {response.status_code}")
+            print(response.text)
+            return None
+
+    def update_main_database(self, entry_id, food_items=[], quantities=[]):
+        update = EntryUpdate().totals(food_items, quantities).status("已完成")
+        if self.commit_entry(entry_id, update) is not None:
+            return True
+        try:
+            self.update_status(entry_id, "出错")
+        except Exception as e:
+            print(f"更新Notion条目状态失败: {e}")
+        return False
+
+    def update_status(self, entry_id, status):
+        """更新主数据库条目的状态"""
+        url = f"{NOTION_API_URL}/pages/{entry_id}"
+        payload = {"properties": {"状态": {"select": {"name": status}}}}
+        response = self._request("PATCH", url, json=payload)
         if response.status_code == 200:
             return True
         else:
+            print(f"更新Notion条目状态失败: {response.status_code}")
             return False
 
     def create_food_item(self, food_item: FoodItem):
         """在Notion数据库中创建食物条目"""
 
         if not self.query_food_item(food_item.name, food_item.unit, food_item.calories):
-            url = f"https://api.notion.com/v1/pages"
-            payload = {
-                "parent": {"database_id": self.food_database_id},
-                "properties": {
-                    "名称": {
-                        "title": [{"text": {"content": food_item.name}}],
-                    },
-                    "热量": {
-                        "number": food_item.calories,
-                    },
-                    "单位": {
-                        "select": {"name": food_item.unit},
-                    },
-                    "蛋白质": {
-                        "number": food_item.protein,
-                    },
-                    "脂肪": {
-                        "number": food_item.fat,
-                    },
-                    "碳水": {
-                        "number": food_item.carbs,
-                    },
-                    "大致克数": {
-                        "number": food_item.grams,
-                    },
-                    "状态": {
-                        "select": {"name": "正常"},
-                    },
-                },
-            }
-            response = requests.post(url, headers=notion_headers, json=payload)
+            url = f"{NOTION_API_URL}/pages"
+            payload = new_food_page(self.food_database_id, food_item)
+            response = self._request("POST", url, json=payload)
 
             if response.status_code == 200:
                 print(
@@ -160,17 +445,9 @@ class Notion:
             )["id"]
 
     def query_food_item(self, food_name, unit, calories=None):
-        url = f"https://api.notion.com/v1/databases/{self.food_database_id}/query"
-        payload = {
-            "filter": {
-                "and": [
-                    {"property": "名称", "title": {"equals": food_name}},
-                    {"property": "单位", "select": {"equals": unit}},
-                    {"property": "热量", "number": {"equals": calories}},
-                ]
-            }
-        }
-        response = requests.post(url, headers=notion_headers, json=payload)
+        url = f"{NOTION_API_URL}/databases/{self.food_database_id}/query"
+        payload = food_lookup_query(food_name, unit, calories)
+        response = self._request("POST", url, json=payload)
         if response.status_code == 200:
             results = response.json()["results"]
             if results:
@@ -181,94 +458,48 @@ class Notion:
 
     def get_all_food_items(self):
         """
-        return"""
-        output = []
-        url = f"https://api.notion.com/v1/databases/{self.food_database_id}/query"
-        payload = {
-            "filter": {
-                "property": "名称",
-                "rich_text": {
-                    "is_not_empty": True,
-                },
-            }
-        }
-        response = requests.post(url, headers=notion_headers, json=payload)
-        if response.status_code == 200:
-            results = response.json()["results"]
-            for result in results:
-                food_item = FoodItem(
-                    name=result["properties"]["名称"]["title"][0]["text"]["content"],
-                    calories=result["properties"]["热量"]["number"],
-                    unit=result["properties"]["单位"]["select"]["name"],
-                    protein=result["properties"]["蛋白质"]["number"],
-                    fat=result["properties"]["脂肪"]["number"],
-                    carbs=result["properties"]["碳水"]["number"],
-                    grams=result["properties"]["大致克数"]["number"],
-                )
-                food_item.notion_id = result["id"]
-                output.append(food_item)
-            return output
-        else:
-            print(f"获取食物条目失败: {response.status_code}")
-            print(response.json())
+        return: [FoodItem, ...]"""
+        try:
+            return list(self.iter_all_food_items())
+        except requests.RequestException as e:
+            print(f"获取食物条目失败: {e}")
+            return None
+
+    def ensure_food_ids(self, food_items):
+        """为还没有notion_id的食物创建Notion页面"""
+        for food_item in food_items:
+            if not food_item.notion_id:
+                food_item.notion_id = self.create_food_item(food_item)
+        return food_items
 
     def create_associations(self, entry_id, food_items):
         """在Notion数据库中创建食物条目与主条目的关联"""
-        relations = []
-        for food_item in food_items:
-            food_item_id = food_item.notion_id
-            if not food_item_id:
-                food_item_id = self.create_food_item(food_item)
-            relations.append({"id": food_item_id})
-        print(f"创建关联: {relations}")
-        url = f"https://api.notion.com/v1/pages/{entry_id}"
-        payload = {
-            "properties": {
-                "食物": {
-                    "relation": relations,
-                },
-            }
-        }
-        response = requests.patch(url, headers=notion_headers, json=payload)
-        if response.status_code == 200:
-            return True
-        else:
-            print(f"创建关联失败: {response.status_code}")
-            print(response.json())
-            return False
+        update = EntryUpdate().relations(self.ensure_food_ids(food_items))
+        print(f"创建关联: {update.properties['食物']['relation']}")
+        return self.commit_entry(entry_id, update) is not None
 
     def get_update_food(self):
         """更新食物条目"""
-        url = f"https://api.notion.com/v1/databases/{self.food_database_id}/query"
-        payload = {"filter": {"property": "状态", "select": {"equals": "异常"}}}
-
-        response = requests.post(url, headers=notion_headers, json=payload)
+        try:
+            return list(self.iter_update_food())
+        except requests.RequestException as e:
+            print(f"获取食物条目失败: {e}")
+            return []
 
+    def get_page(self, page_id):
+        """获取单个页面对象"""
+        url = f"{NOTION_API_URL}/pages/{page_id}"
+        response = self._request("GET", url)
         if response.status_code == 200:
-            results = response.json()["results"]
-            food_items = []
-            for result in results:
-                food_item = FoodItem(
-                    name=result["properties"]["名称"]["title"][0]["text"]["content"],
-                    calories=result["properties"]["热量"]["number"],
-                    unit=result["properties"]["单位"]["select"]["name"],
-                    protein=result["properties"]["蛋白质"]["number"],
-                    fat=result["properties"]["脂肪"]["number"],
-                    carbs=result["properties"]["碳水"]["number"],
-                    grams=result["properties"]["大致克数"]["number"],
-                )
-                food_item.notion_id = result["id"]
-                food_items.append(food_item)
-            return food_items
+            return response.json()
         else:
-            print(f"获取食物条目失败: {response.status_code}")
-            print(response.json())
-            return []
+            print(f"获取页面失败: {response.status_code}")
+            return None
 
     def get_updated_associations(self, food_item: FoodItem):
         """获取食物条目与主条目的关联"""
-        url = f"https://api.notion.com/v1/pages/{food_item.notion_id}"
-        response = requests.get(url, headers=notion_headers)
+        url = f"{NOTION_API_URL}/pages/{food_item.notion_id}"
+        response = self._request("GET", url)
         if response.status_code == 200:
             results = response.json()
             if "properties" in results and "关联" in results["properties"]:
@@ -281,56 +512,9 @@ class Notion:
             print(response.json())
             return None
 
-    def get_food_items(self, entry_id):
-        url = f"https://api.notion.com/v1/pages/{entry_id}"
-        response = requests.get(url, headers=notion_headers)
-        if response.status_code == 200:
-            result = response.json()
-            food_item = FoodItem(
-                name=result["properties"]["名称"]["title"][0]["text"]["content"],
-                calories=result["properties"]["热量"]["number"],
-                unit=result["properties"]["单位"]["select"]["name"],
-                protein=result["properties"]["蛋白质"]["number"],
-                fat=result["properties"]["脂肪"]["number"],
-                carbs=result["properties"]["碳水"]["number"],
-                grams=result["properties"]["大致克数"]["number"],
-            )
-            food_item.notion_id = result["id"]
-            return food_item
-        else:
-            print(f"获取食物条目失败: {response.status_code}")
-            print(response.json())
-            return None
-
-    def get_food_item_and_quantities(self, entry_id):
-        """获取条目中的数量"""
-        url = f"https://api.notion.com/v1/pages/{entry_id}"
-        response = requests.get(url, headers=notion_headers)
-        if response.status_code == 200:
-            results = response.json()
-            if "properties" in results:
-                if "数量" in results["properties"]:
-                    quantities = json.loads(
-                        results["properties"]["数量"]["rich_text"][0]["text"]["content"]
-                    )
-                else:
-                    print(f"未找到数量: {entry_id}")
-                if "食物" in results["properties"]:
-                    food_items_ids = results["properties"]["食物"]["relation"]
-                    food_items = []
-                    for food_item_id in food_items_ids:
-                        food_item = self.get_food_items(food_item_id["id"])
-                        food_items.append(food_item)
-                    return food_items, quantities
-
-        else:
-            print(f"获取数量失败: {response.status_code}")
-            print(response.json())
-            return None
-
     def fix_updated_status(self, food_item: FoodItem):
         """修复食物条目的状态"""
-        url = f"https://api.notion.com/v1/pages/{food_item.notion_id}"
+        url = f"{NOTION_API_URL}/pages/{food_item.notion_id}"
         payload = {
             "properties": {
                 "状态": {
@@ -338,7 +522,7 @@ class Notion:
                 },
             }
         }
-        response = requests.patch(url, headers=notion_headers, json=payload)
+        response = self._request("PATCH", url, json=payload)
         if response.status_code == 200:
             return True
         else:
@@ -347,21 +531,21 @@ class Notion:
             return False
 
     def delete_no_association_food(self):
-        url = f"https://api.notion.com/v1/databases/{self.food_database_id}/query"
+        url = f"{NOTION_API_URL}/databases/{self.food_database_id}/query"
         payload = {
             "filter": {
                 "property": "关联",
                 "relation": {"is_empty": True},
             }
         }
-        response = requests.post(url, headers=notion_headers, json=payload)
+        response = self._request("POST", url, json=payload)
         if response.status_code == 200:
             results = response.json()["results"]
             for result in results:
                 food_item_id = result["id"]
 
-                url = f"https://api.notion.com/v1/pages/{food_item_id}"
-                response = requests.delete(url, headers=notion_headers)
+                url = f"{NOTION_API_URL}/pages/{food_item_id}"
+                response = self._request("DELETE", url)
                 if response.status_code == 200:
                     print(f"删除食物条目成功: {food_item_id}")
                 else:
@@ -390,5 +574,3 @@ if __name__ == "__main__":
     # entry_id = entries[0]["id"]
     # food_item_id = notion.query_food_item("苹果")["id"]
     # notion.create_association(food_item_id, entry_id)
-
-    print(notion.get_food_item_and_quantities("1dc505a6-7b0e-8033-accf-f6b0663d8e08"))
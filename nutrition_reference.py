@@ -0,0 +1,348 @@
+"""离线营养参考库: 批量导入CSV/JSONL营养成分表，本地未命中时先查这里再问LLM
+
+用法:
+    python nutrition_reference.py import foods.csv [--source 中国食物成分表]
+    python nutrition_reference.py search 鸡胸肉 [--unit 克]
+"""
+
+import argparse
+import csv
+import functools
+import json
+import math
+import os
+import sqlite3
+import threading
+from collections import Counter
+
+from FoodItem import FoodItem
+from fuzzy_match import char_coverage, char_ngrams
+
+
+# 为空字符串时不使用参考库
+NUTRITION_REFERENCE_PATH = os.getenv(
+    "NUTRITION_REFERENCE_PATH", "nutrition_reference.db"
+)
+# 名称不完全相同时接受参考条目的最低相似度，0(默认)表示只做精确匹配
+REFERENCE_MATCH_THRESHOLD = float(os.getenv("REFERENCE_MATCH_THRESHOLD", "0"))
+# 相似名称还需字符互相覆盖的最低比例，避免"鸡胸肉汉堡"用上"鸡胸肉"的营养
+REFERENCE_MATCH_COVERAGE = float(os.getenv("REFERENCE_MATCH_COVERAGE", "0.9"))
+
+# 导入文件的列名别名: 别名 -> 字段
+COLUMN_ALIASES = {
+    "name": "name",
+    "food_name": "name",
+    "名称": "name",
+    "食物名称": "name",
+    "unit": "unit",
+    "单位": "unit",
+    "calories": "calories",
+    "kcal": "calories",
+    "energy_kcal": "calories",
+    "热量": "calories",
+    "能量": "calories",
+    "protein": "protein",
+    "蛋白质": "protein",
+    "fat": "fat",
+    "脂肪": "fat",
+    "carbs": "carbs",
+    "carbohydrate": "carbs",
+    "碳水": "carbs",
+    "碳水化合物": "carbs",
+    "grams": "grams",
+    "大致克数": "grams",
+}
+NUTRIENT_FIELDS = ("calories", "protein", "fat", "carbs")
+# 可由每克数据换算的重量单位
+MASS_UNITS = {"克": 1, "千克": 1000, "斤": 500}
+
+UPSERT_REFERENCE_SQL = """
+    INSERT INTO reference_foods (name, unit, calories, protein, fat, carbs, grams, source)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(name, unit) DO UPDATE SET
+        calories=excluded.calories, protein=excluded.protein, fat=excluded.fat,
+        carbs=excluded.carbs, grams=excluded.grams, source=excluded.source
+"""
+
+
+@functools.lru_cache(maxsize=256)
+def _column_field(column):
+    return COLUMN_ALIASES.get(str(column).strip().lower())
+
+
+def _float(value):
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_reference_row(record, source=None):
+    """把一条导入记录转换为表中的一行，缺少名称或热量时返回None
+
+    有unit列时各营养值按每单位计；没有unit列时视为每100克，换算为每克(单位"克")，
+    与本地食物库的约定一致。"""
+    fields = {}
+    for key, value in record.items():
+        field = _column_field(key)
+        if field and field not in fields:
+            fields[field] = value.strip() if isinstance(value, str) else value
+    name = fields.get("name")
+    calories = _float(fields.get("calories"))
+    if not name or calories is None:
+        return None
+    nutrients = [calories] + [
+        _float(fields.get(field)) for field in NUTRIENT_FIELDS[1:]
+    ]
+    unit = fields.get("unit")
+    grams = _float(fields.get("grams"))
+    if not unit:
+        unit = "克"
+        nutrients = [value / 100 if value is not None else None for value in nutrients]
+    if unit == "克":
+        grams = 1
+    return (name, unit, *nutrients, grams, source)
+
+
+def iter_reference_file(path):
+    """逐条读取CSV或JSONL文件，不把整个文件载入内存"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def _similarity(a, b):
+    """字符n-gram计数向量的余弦相似度"""
+    va, vb = Counter(char_ngrams(a)), Counter(char_ngrams(b))
+    dot = sum(count * vb[gram] for gram, count in va.items())
+    if not dot:
+        return 0.0
+    norm = math.sqrt(sum(c * c for c in va.values()) * sum(c * c for c in vb.values()))
+    return dot / norm
+
+
+class NutritionReference:
+    """只读为主的营养参考库，与本地食物库分开存放
+
+    reference_foods按(名称, 单位)唯一；reference_fts是名称上的FTS5 trigram索引，
+    用于按名称片段找候选，再按字符相似度挑选。"""
+
+    def __init__(self, db_path=NUTRITION_REFERENCE_PATH):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS reference_foods (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                unit TEXT NOT NULL,
+                calories REAL,
+                protein REAL,
+                fat REAL,
+                carbs REAL,
+                grams REAL,
+                source TEXT,
+                UNIQUE (name, unit)
+            )
+            """
+        )
+        try:
+            self.conn.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS reference_fts USING fts5(
+                    name, content='reference_foods', content_rowid='id',
+                    tokenize='trigram'
+                )
+                """
+            )
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            # SQLite 3.34以前没有trigram分词器，只做精确匹配
+            print(f"参考库不支持FTS5 trigram，仅使用精确匹配: {e}")
+            self.fts = False
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def import_records(self, records, source=None):
+        """在一个事务中流式写入记录，并重建名称索引
+
+        records: 字典的可迭代对象(见normalize_reference_row)
+        return: {"imported": 写入行数, "skipped": 跳过的无效行数}"""
+        stats = {"imported": 0, "skipped": 0}
+
+        def rows():
+            for record in records:
+                row = normalize_reference_row(record, source)
+                if row is None:
+                    stats["skipped"] += 1
+                    continue
+                stats["imported"] += 1
+                yield row
+
+        with self.lock, self.conn:
+            self.conn.executemany(UPSERT_REFERENCE_SQL, rows())
+            if self.fts:
+                self.conn.execute(
+                    "INSERT INTO reference_fts(reference_fts) VALUES('rebuild')"
+                )
+        return stats
+
+    def import_file(self, path, source=None):
+        return self.import_records(
+            iter_reference_file(path), source or os.path.basename(path)
+        )
+
+    def count(self):
+        with self.lock:
+            result = self.conn.execute("SELECT COUNT(*) FROM reference_foods")
+            return result.fetchone()[0]
+
+    def _row_to_food_item(self, row, name, unit, factor=1):
+        ref_calories, protein, fat, carbs, grams = row
+
+        def scaled(value):
+            return value * factor if value is not None else None
+
+        return FoodItem(
+            name=name,
+            calories=scaled(ref_calories),
+            unit=unit,
+            protein=scaled(protein),
+            fat=scaled(fat),
+            carbs=scaled(carbs),
+            grams=scaled(grams) if unit != "克" else 1,
+        )
+
+    def _exact(self, name, unit):
+        return self.conn.execute(
+            "SELECT calories, protein, fat, carbs, grams FROM reference_foods WHERE name=? AND unit=?",
+            (name, unit),
+        ).fetchone()
+
+    def search(self, name, unit=None, k=10):
+        """找出与名称共享字符片段的候选，按字符相似度排序
+
+        unit: 只在该单位的条目中查找
+        return: [(名称, 单位, 相似度), ...]，按相似度降序"""
+        unit_filter = " AND reference_foods.unit=?" if unit else ""
+        if self.fts and len(name) >= 3:
+            # 名称的任一trigram命中即为候选，再按bm25取前200个
+            trigrams = {name[i : i + 3] for i in range(len(name) - 2)}
+            query = " OR ".join('"' + t.replace('"', '""') + '"' for t in trigrams)
+            sql = f"""SELECT reference_foods.name, reference_foods.unit
+                      FROM reference_fts JOIN reference_foods
+                      ON reference_foods.id = reference_fts.rowid
+                      WHERE reference_fts MATCH ?{unit_filter}
+                      ORDER BY rank LIMIT 200"""
+            params = [query]
+        else:
+            # trigram至少需要3个字符，短名称用LIKE扫描
+            sql = f"""SELECT name, unit FROM reference_foods
+                      WHERE name LIKE ?{unit_filter} LIMIT 200"""
+            params = [f"%{name}%"]
+        if unit:
+            params.append(unit)
+        with self.lock:
+            candidates = self.conn.execute(sql, params).fetchall()
+            if self.fts and len(name) >= 3:
+                # trigram只能找到比查询长的名称，被查询包含的短名称按子串精确查找
+                substrings = {
+                    name[i:j]
+                    for i in range(len(name))
+                    for j in range(i + 2, len(name) + 1)
+                }
+                candidates += self.conn.execute(
+                    f"""SELECT name, unit FROM reference_foods
+                        WHERE name IN (SELECT value FROM json_each(?)){unit_filter}""",
+                    [json.dumps(list(substrings), ensure_ascii=False)] + params[1:],
+                ).fetchall()
+            candidates = list(dict.fromkeys(candidates))
+        scored = [
+            (candidate, candidate_unit, _similarity(name, candidate))
+            for candidate, candidate_unit in candidates
+        ]
+        scored.sort(key=lambda x: x[2], reverse=True)
+        return scored[:k]
+
+    def lookup(
+        self,
+        name,
+        unit,
+        threshold=REFERENCE_MATCH_THRESHOLD,
+        coverage=REFERENCE_MATCH_COVERAGE,
+    ):
+        """查找(名称, 单位)的营养信息
+
+        依次尝试: 精确匹配、按每克数据换算重量单位、名称相似的同单位条目(threshold>0时)。
+        精确匹配和换算返回请求的名称，写入本地库后下次可直接精确命中；相似匹配返回
+        参考条目自己的名称，不会把别的食物的营养记在请求的名称下。
+        return: FoodItem or None"""
+        factor = MASS_UNITS.get(unit)
+        with self.lock:
+            row = self._exact(name, unit)
+            if row is None and factor and unit != "克":
+                row = self._exact(name, "克")
+                if row is not None:
+                    return self._row_to_food_item(row, name, unit, factor)
+        if row is not None:
+            return self._row_to_food_item(row, name, unit)
+        if threshold <= 0:
+            return None
+        search_unit = "克" if factor else unit
+        for candidate, candidate_unit, score in self.search(name, search_unit, k=5):
+            if score < threshold:
+                break
+            if (
+                min(char_coverage(name, candidate), char_coverage(candidate, name))
+                < coverage
+            ):
+                continue
+            with self.lock:
+                row = self._exact(candidate, candidate_unit)
+            print(f"参考库相似匹配: {name} -> {candidate} ({score:.2f})")
+            return self._row_to_food_item(row, candidate, unit, factor or 1)
+        return None
+
+
+def open_reference(db_path=NUTRITION_REFERENCE_PATH):
+    """参考库文件存在时打开，否则返回None(未导入过参考数据)"""
+    if not db_path or not os.path.exists(db_path):
+        return None
+    return NutritionReference(db_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=NUTRITION_REFERENCE_PATH, help="参考库路径")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="导入CSV/JSONL文件")
+    import_parser.add_argument("paths", nargs="+")
+    import_parser.add_argument("--source", help="数据来源，默认为文件名")
+    search_parser = commands.add_parser("search", help="按名称查找")
+    search_parser.add_argument("name")
+    search_parser.add_argument("--unit")
+    args = parser.parse_args(argv)
+
+    reference = NutritionReference(args.db)
+    if args.command == "import":
+        for path in args.paths:
+            print(f"{path}: {reference.import_file(path, args.source)}")
+        print(f"参考库共{reference.count()}条")
+    else:
+        food_item = reference.lookup(args.name, args.unit or "克")
+        print(food_item)
+        for name, unit, score in reference.search(args.name, args.unit):
+            print(f"{score:.3f}  {name} ({unit})")
+    reference.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 import re
+import threading
+import unicodedata
 
 
 # 数字中文转换词典
 chinese_digit_map = {
+    "零": 0,
+    "〇": 0,
     "一": 1,
     "二": 2,
     "两": 2,
@@ -13,53 +17,203 @@ chinese_digit_map = {
     "七": 7,
     "八": 8,
     "九": 9,
+}
+
+# 中文数位
+chinese_unit_map = {
     "十": 10,
-    "半": 0.5,
+    "百": 100,
+    "千": 1000,
+}
+
+# 单位别名表: 别名 -> 规范单位。新增单位只需在这里添加
+unit_aliases = {
+    # 重量
+    "克": "克",
+    "g": "克",
+    "公克": "克",
+    "千克": "千克",
+    "kg": "千克",
+    "公斤": "千克",
+    "斤": "斤",
+    # 容量
+    "毫升": "毫升",
+    "ml": "毫升",
+    "升": "升",
+    "l": "升",
+    # 计数
+    "个": "个",
+    "只": "只",
+    "颗": "颗",
+    "枚": "枚",
+    "根": "根",
+    "条": "条",
+    "片": "片",
+    "块": "块",
+    "坨": "坨",
+    "粒": "粒",
+    "张": "张",
+    "串": "串",
+    "份": "份",
+    "碗": "碗",
+    "杯": "杯",
+    "盘": "盘",
+    "碟": "碟",
+    "包": "包",
+    "袋": "袋",
+    "盒": "盒",
+    "瓶": "瓶",
+    "罐": "罐",
+    "听": "听",
+    "勺": "勺",
+    "汤匙": "勺",
+    "茶匙": "茶匙",
 }
 
+# "千"后接"克"时属于单位"千克"
+_chinese_number = "(?:[" + "".join(chinese_digit_map) + "十百万]|千(?!克))+"
+_number_pattern = (
+    r"\d+(?:\.\d+)?(?:/\d+)?"
+    rf"|{_chinese_number}分之{_chinese_number}"
+    rf"|{_chinese_number}(?:点{_chinese_number})?"
+    r"|半"
+)
+# 数量中可能出现的字符，名称不能以这些字符结尾，否则会吞掉数量的前半部分
+_numeral_chars = re.escape(
+    "0123456789./点" + "".join(chinese_digit_map) + "".join(chinese_unit_map) + "万"
+)
+_unit_pattern = "|".join(
+    re.escape(unit) for unit in sorted(unit_aliases, key=len, reverse=True)
+)
 
-def convert_chinese_num(chinese_str):
-    """将中文数字转换为阿拉伯数字"""
-    if chinese_str in chinese_digit_map:
-        return chinese_digit_map[chinese_str]
-    return None
+# 数量+单位+名称，如"两碗米饭"、"1.5碗米饭"、"200ml牛奶"、"一个半苹果"
+_prefix_re = re.compile(
+    rf"^(?P<quantity>{_number_pattern})\s*(?P<unit>{_unit_pattern})(?P<half>半)?\s*(?P<name>.+)$",
+    re.IGNORECASE,
+)
+# 名称+数量+单位，如"米饭200g"、"馒头一个半"
+_suffix_re = re.compile(
+    rf"^(?P<name>.+?)(?<![{_numeral_chars}])\s*(?P<quantity>{_number_pattern})\s*(?P<unit>{_unit_pattern})(?P<half>半)?$",
+    re.IGNORECASE,
+)
+_separator_re = re.compile(r"[,，、和及与\s]+")
 
+# 规则解析与LLM回退的计数
+parse_stats = {"parser": 0, "llm_fallback": 0}
+_stats_lock = threading.Lock()
 
-def parse_food_item(item_text):
-    """解析单个食品项"""
-    item_text = item_text.strip()
 
-    # 匹配阿拉伯数字或中文数字
-    quantity_match = re.match(r"^([0-9一二两三四五六七八九十半]+)(.*)", item_text)
+def record_parse(kind):
+    """记录一次解析结果来源: "parser"或"llm_fallback" """
+    with _stats_lock:
+        parse_stats[kind] += 1
 
-    if quantity_match:
-        # 提取数量
-        quantity_str = quantity_match.group(1)
-        remainder = quantity_match.group(2).strip()
 
-        # 转换数量
-        if quantity_str.isdigit():
-            quantity = int(quantity_str)
+def llm_fallback_rate():
+    """LLM回退占全部解析的比例"""
+    with _stats_lock:
+        total = parse_stats["parser"] + parse_stats["llm_fallback"]
+        return parse_stats["llm_fallback"] / total if total else 0.0
+
+
+def _whole(value):
+    """整数值返回int，保持与原先解析结果一致"""
+    return int(value) if float(value).is_integer() else value
+
+
+def _convert_chinese_integer(chinese_str):
+    """return: 整数；不是完整规范的中文数字(如约数"两三"、"十十")时返回None"""
+    total = 0
+    section = 0
+    number = None
+    # 节内上一个数位，数位必须从大到小
+    last_unit = None
+    for char in chinese_str:
+        if char in chinese_digit_map:
+            if number:
+                # 两个非零数字相连，如"两三个"，是约数而不是一个数
+                return None
+            number = chinese_digit_map[char]
+        elif char in chinese_unit_map:
+            value = chinese_unit_map[char]
+            if last_unit is not None and value >= last_unit:
+                return None
+            # "十二"中的"十"前面省略了"一"
+            section += (1 if number is None else number) * value
+            number = None
+            last_unit = value
+        elif char == "万":
+            if total or (not section and number is None):
+                return None
+            total = (section + (number or 0)) * 10000
+            section = 0
+            number = None
+            last_unit = None
         else:
-            quantity = convert_chinese_num(quantity_str)
-            if quantity is None:
+            return None
+    return total + section + (number or 0)
+
+
+def convert_chinese_num(chinese_str):
+    """将中文数字转换为阿拉伯数字，支持"二十五"、"一百零五"、"一点五"、"三分之一"、"半" """
+    if chinese_str == "半":
+        return 0.5
+    if "分之" in chinese_str:
+        denominator, numerator = chinese_str.split("分之", 1)
+        denominator = _convert_chinese_integer(denominator)
+        numerator = _convert_chinese_integer(numerator)
+        if not denominator or numerator is None:
+            return None
+        return numerator / denominator
+    if "点" in chinese_str:
+        integer, decimal = chinese_str.split("点", 1)
+        integer = _convert_chinese_integer(integer)
+        if integer is None or not all(c in chinese_digit_map for c in decimal):
+            return None
+        digits = "".join(str(chinese_digit_map[c]) for c in decimal)
+        return float(f"{integer}.{digits}")
+    if not chinese_str or any(
+        c not in chinese_digit_map and c not in chinese_unit_map and c != "万"
+        for c in chinese_str
+    ):
+        return None
+    return _convert_chinese_integer(chinese_str)
+
+
+def parse_quantity(quantity_str):
+    """解析阿拉伯数字、小数、分数或中文数字"""
+    if not quantity_str:
+        return 1
+    if quantity_str[0].isdigit():
+        if "/" in quantity_str:
+            numerator, denominator = quantity_str.split("/")
+            if int(denominator) == 0:
                 raise ValueError(f"无法解析数量: {quantity_str}")
-    else:
-        # 如果没有指定数量，默认为1
-        quantity = 1
-        remainder = item_text
-
-    # 匹配单位
-    unit_match = re.match(r"^([个杯碗份块片克g千克kg包]+)(.*)", remainder)
-
-    if unit_match:
-        unit = unit_match.group(1)
-        food_name = unit_match.group(2).strip()
-    else:
-        unit = "个"  # 默认单位
-        food_name = remainder
+            return _whole(int(numerator) / int(denominator))
+        return _whole(float(quantity_str))
+    quantity = convert_chinese_num(quantity_str)
+    if quantity is None:
+        raise ValueError(f"无法解析数量: {quantity_str}")
+    return _whole(quantity)
+
+
+def parse_food_item(item_text):
+    """解析单个食品项
+
+    return: (数量, 规范单位, 食品名称)"""
+    item_text = unicodedata.normalize("NFKC", item_text).strip()
+
+    match = _prefix_re.match(item_text) or _suffix_re.match(item_text)
+    if not match:
         raise ValueError(f"无法解析单位: {item_text}，请指定单位。")
 
+    quantity = parse_quantity(match.group("quantity"))
+    if match.groupdict().get("half"):
+        # "一个半" = 1.5个
+        quantity = _whole(quantity + 0.5)
+    unit = unit_aliases[match.group("unit").lower()]
+    food_name = match.group("name").strip()
+
     # 确保食品名称不为空
     if not food_name:
         raise ValueError(f"无法解析食品名称: {item_text}")
@@ -72,7 +226,7 @@ def parse_multiple_food(input_text):
     output: [(food_name, quantity, unit), ...]"""
     # 使用常见分隔符分割输入
     output = []
-    food_items = re.split(r"[,，、和及与\s]+", input_text)
+    food_items = _separator_re.split(input_text)
 
     # 过滤空项
     food_items = [item for item in food_items if item.strip()]
@@ -89,12 +243,32 @@ def parse_multiple_food(input_text):
             raise ValueError(f"无法解析食品项: {item}")
         else:
             output.append((food_name, quantity, unit))
+    record_parse("parser")
     return output
 
 
 if __name__ == "__main__":
-    # 测试代码
-    # test_input = "10坨鸡块，2杯米饭，半份沙拉"
-    # result = parse_multiple_food(test_input)
-    # print(result)  # 输出解析结果
-    print(parse_food_item("一根白面包"))  # 测试单个食品项解析
+    # 回归用例: python parse_input.py
+    cases = {
+        "一根白面包": (1, "根", "白面包"),
+        "两碗米饭": (2, "碗", "米饭"),
+        "米饭200g": (200, "克", "米饭"),
+        "馒头一个半": (1.5, "个", "馒头"),
+        "一个半苹果": (1.5, "个", "苹果"),
+        "两个半馒头": (2.5, "个", "馒头"),
+        "半个西瓜": (0.5, "个", "西瓜"),
+        "一百零五克米饭": (105, "克", "米饭"),
+        "五花肉200g": (200, "克", "五花肉"),
+        "三明治一个": (1, "个", "三明治"),
+        "牛奶零点五升": (0.5, "升", "牛奶"),
+    }
+    for text, expected in cases.items():
+        assert parse_food_item(text) == expected, (text, parse_food_item(text))
+    # 约数或数字被名称截断时应报错(由调用方回退到LLM)，不能返回错误结果
+    for text in ["两三个苹果", "一万个", "零点五个", "苹果两三个", "十十个橘子"]:
+        try:
+            result = parse_food_item(text)
+        except ValueError:
+            continue
+        raise AssertionError((text, result))
+    print(f"{len(cases) + 5} 个用例通过")
@@ -0,0 +1,83 @@
+import asyncio
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """线程安全的令牌桶限流器，速率会根据限流反馈自适应调整
+
+    rate: 每秒允许的请求数(上限)
+    capacity: 桶容量，即允许的突发请求数
+    min_rate: 被限流后速率下降的下限
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.min_rate = min_rate or rate / 10
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """预留一个令牌，返回调用方需要等待的秒数(不阻塞)"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = max(0.0, self.blocked_until - now)
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def acquire(self):
+        """阻塞直到拿到令牌"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """协程版acquire，等待时不阻塞事件循环"""
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_throttled(self, retry_after=None):
+        """收到429/5xx时调用：速率减半，并按Retry-After暂停所有调用方"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def on_success(self):
+        """请求成功时调用：速率线性恢复到上限"""
+        with self.lock:
+            if self.rate < self.max_rate:
+                now = time.monotonic()
+                self._refill(now)
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """带随机抖动的指数退避时间(秒)"""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def parse_retry_after(value):
+    """解析Retry-After响应头(秒数)，无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
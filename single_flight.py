@@ -0,0 +1,102 @@
+"""进程内的single-flight: 同一键的并发请求只执行一次，其余请求等待并共享结果"""
+
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """线程版本。键正在执行时，新的请求等待该次执行的结果而不是再执行一次；
+    执行结束后键即被移除，之后的请求会重新执行(调用方应先查本地缓存/数据库)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        """return: fn()的结果"""
+        return self.do_many([key], lambda keys: [fn()])[key]
+
+    def do_many(self, keys, fn):
+        """批量版本: 没有在执行中的键合并为一次fn调用，其余键等待已有的执行
+
+        fn: 接收键列表，返回与之一一对应的结果列表
+        return: {键: 结果}；fn抛出的异常会传给所有等待这些键的调用方"""
+        own = {}
+        waiting = {}
+        with self.lock:
+            for key in dict.fromkeys(keys):
+                call = self.calls.get(key)
+                if call is None:
+                    own[key] = self.calls[key] = _Call()
+                else:
+                    waiting[key] = call
+        if own:
+            self._run(own, fn)
+        results = {}
+        for key, call in list(own.items()) + list(waiting.items()):
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            results[key] = call.result
+        return results
+
+    def _run(self, own, fn):
+        try:
+            for call, result in zip(own.values(), fn(list(own))):
+                call.result = result
+        except Exception as e:
+            for call in own.values():
+                call.error = e
+        finally:
+            with self.lock:
+                for key in own:
+                    del self.calls[key]
+            for call in own.values():
+                call.done.set()
+
+
+class AsyncSingleFlight:
+    """asyncio版本，在同一个事件循环内使用，fn为协程函数"""
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do_many(self, keys, fn):
+        """见SingleFlight.do_many"""
+        loop = asyncio.get_running_loop()
+        own = {}
+        waiting = {}
+        for key in dict.fromkeys(keys):
+            future = self.calls.get(key)
+            if future is None:
+                own[key] = self.calls[key] = loop.create_future()
+            else:
+                waiting[key] = future
+        if own:
+            try:
+                values = list(await fn(list(own)))
+            except Exception as e:
+                for future in own.values():
+                    future.set_exception(e)
+            except BaseException:
+                # 被取消时让等待者也结束
+                for future in own.values():
+                    future.cancel()
+                raise
+            else:
+                for i, future in enumerate(own.values()):
+                    future.set_result(values[i] if i < len(values) else None)
+            finally:
+                for key in own:
+                    del self.calls[key]
+        results = {}
+        for key, future in list(own.items()) + list(waiting.items()):
+            results[key] = await asyncio.shield(future)
+        return results
@@ -0,0 +1,76 @@
+import hmac
+import json
+import logging
+import os
+from urllib.parse import parse_qs
+
+from metrics import MetricsHandler
+
+
+# 设置后请求需带X-Webhook-Secret头或?token=参数
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# 放入触发队列表示处理全部待处理条目
+ALL_PENDING = "*"
+
+
+def extract_page_ids(body):
+    """从webhook请求体中提取页面ID
+
+    支持Notion集成webhook({"entity": {"id": ...}})、数据库自动化的
+    "发送webhook"动作({"data": {"id": ...}})以及本地触发({"entry_id": ...})。
+    return: [page_id, ...]，为空表示处理全部待处理条目"""
+    if not isinstance(body, dict):
+        return []
+    page_ids = []
+    for key in ("entity", "data"):
+        value = body.get(key)
+        if isinstance(value, dict) and value.get("id"):
+            page_ids.append(value["id"])
+    for key in ("entry_id", "page_id"):
+        if body.get(key):
+            page_ids.append(body[key])
+    return page_ids
+
+
+def make_trigger_handler(triggers):
+    """返回处理/metrics和POST /webhook、/trigger的请求处理类
+
+    triggers: 接收页面ID的队列"""
+
+    class TriggerHandler(MetricsHandler):
+        def do_POST(self):
+            path, _, query = self.path.partition("?")
+            if path not in ("/webhook", "/trigger"):
+                self.send_error(404)
+                return
+            if WEBHOOK_SECRET:
+                token = (
+                    self.headers.get("X-Webhook-Secret")
+                    or parse_qs(query).get("token", [""])[0]
+                )
+                # compare_digest不接受含非ASCII字符的str，统一按字节比较
+                if not hmac.compare_digest(
+                    token.encode("utf-8"), WEBHOOK_SECRET.encode("utf-8")
+                ):
+                    self.send_error(403)
+                    return
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                self.send_error(400)
+                return
+            if isinstance(body, dict) and "verification_token" in body:
+                # Notion订阅webhook时发送的验证请求，需要把token填回Notion
+                logging.info(f"收到webhook验证token: {body['verification_token']}")
+            else:
+                page_ids = extract_page_ids(body)
+                for page_id in page_ids or [ALL_PENDING]:
+                    triggers.put(page_id)
+            self.send_response(202)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    return TriggerHandler
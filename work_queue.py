@@ -0,0 +1,251 @@
+"""主数据库条目的持久化任务队列
+
+每个条目一行，按(last_edited_time, 食物描述)判断是否是一次新的编辑: 同一次编辑只入队一次，
+处理完成后确认(ack)；进程在处理中途退出时，租约到期后任务会被重新租出。
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+
+from food_database import ThreadLocalDatabase
+from metrics import WORK_QUEUE_DEPTH, WORK_QUEUE_JOBS, WORK_QUEUE_OLDEST_AGE
+from notion import entry_description
+from rate_limiter import backoff_delay
+
+
+WORK_QUEUE_PATH = os.getenv("WORK_QUEUE_PATH", "work_queue.db")
+# 租约时长(秒)，超过后视为处理者已退出，任务可被重新租出
+WORK_LEASE_SECONDS = float(os.getenv("WORK_LEASE_SECONDS", "600"))
+# 每次最多租出的任务数
+WORK_LEASE_BATCH = int(os.getenv("WORK_LEASE_BATCH", "100"))
+# 同一次编辑最多尝试的次数，超过后不再自动重试，直到条目再次被编辑
+WORK_MAX_ATTEMPTS = int(os.getenv("WORK_MAX_ATTEMPTS", "5"))
+# 已完成任务的保留时间(秒)
+WORK_QUEUE_RETENTION = float(os.getenv("WORK_QUEUE_RETENTION", str(30 * 24 * 3600)))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# 任务状态
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+DEAD = "dead"
+
+# version每次入队新的编辑时加1，ack/fail只作用于租出时的version
+Job = namedtuple("Job", ["entry_id", "version", "entry", "attempts"])
+
+MIGRATIONS = [
+    # 1: 初始结构
+    [
+        """
+        CREATE TABLE IF NOT EXISTS entry_jobs (
+            entry_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 1,
+            edited_time TEXT,
+            description TEXT,
+            entry TEXT,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL,
+            lease_owner TEXT,
+            lease_expires REAL,
+            written_time TEXT,
+            last_error TEXT,
+            enqueued_at REAL,
+            updated_at REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_entry_jobs_state ON entry_jobs (state, available_at)",
+    ],
+]
+
+# 新条目直接插入；已有条目只有在描述变化，或last_edited_time晚于上次入队和
+# 上次写回(我们自己的PATCH也会更新last_edited_time)时才作为新的编辑重新入队
+ENQUEUE_SQL = """
+    INSERT INTO entry_jobs
+        (entry_id, edited_time, description, entry, state, available_at, enqueued_at, updated_at)
+    VALUES (?, ?, ?, ?, 'pending', ?, ?, ?)
+    ON CONFLICT (entry_id) DO UPDATE SET
+        version=version + 1, edited_time=excluded.edited_time,
+        description=excluded.description, entry=excluded.entry, state='pending',
+        attempts=0, available_at=excluded.available_at, lease_owner=NULL,
+        lease_expires=NULL, last_error=NULL, enqueued_at=excluded.enqueued_at,
+        updated_at=excluded.updated_at
+    WHERE excluded.description IS NOT entry_jobs.description
+       OR excluded.edited_time > MAX(
+            COALESCE(entry_jobs.edited_time, ''), COALESCE(entry_jobs.written_time, '')
+       )
+"""
+
+
+def _entry_version(entry):
+    """return: (last_edited_time, 食物描述)，没有描述时为None"""
+    try:
+        description = entry_description(entry)
+    except (KeyError, IndexError, TypeError):
+        description = None
+    return entry.get("last_edited_time"), description
+
+
+class WorkQueue(ThreadLocalDatabase):
+    """SQLite上的条目任务队列，可在多个线程和进程间共享"""
+
+    migrations = MIGRATIONS
+
+    def __init__(self, db_path=WORK_QUEUE_PATH):
+        super().__init__(db_path)
+
+    def enqueue(self, entries):
+        """把条目作为任务入队，已入队或已处理过的同一次编辑不会重复入队
+
+        entries: Notion条目页面对象
+        return: 新入队(含重新入队)的任务数"""
+        now = time.time()
+        rows = []
+        for entry in entries:
+            edited_time, description = _entry_version(entry)
+            rows.append(
+                (
+                    entry["id"],
+                    edited_time,
+                    description,
+                    json.dumps(entry, ensure_ascii=False),
+                    now,
+                    now,
+                    now,
+                )
+            )
+        with self.conn as conn:
+            count = conn.executemany(ENQUEUE_SQL, rows).rowcount
+        WORK_QUEUE_JOBS.inc(count, event="enqueued")
+        return count
+
+    def lease(self, owner=WORKER_ID, limit=WORK_LEASE_BATCH, lease_seconds=None):
+        """租出可处理的任务: 到期的待处理任务，以及租约已过期的任务(处理者中途退出)
+
+        租约过期且已达到WORK_MAX_ATTEMPTS的任务标记为dead，不再租出。
+        return: [Job, ...]，按入队时间排序"""
+        now = time.time()
+        expires = now + (WORK_LEASE_SECONDS if lease_seconds is None else lease_seconds)
+        with self.conn as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                """SELECT entry_id, version, entry, attempts, state FROM entry_jobs
+                   WHERE (state='pending' AND available_at <= ?)
+                      OR (state='leased' AND lease_expires <= ?)
+                   ORDER BY enqueued_at LIMIT ?""",
+                (now, now, limit),
+            ).fetchall()
+            jobs = []
+            dead = []
+            for entry_id, version, entry, attempts, state in rows:
+                if state == LEASED:
+                    WORK_QUEUE_JOBS.inc(event="released")
+                    if attempts >= WORK_MAX_ATTEMPTS:
+                        dead.append((now, entry_id))
+                        continue
+                jobs.append(Job(entry_id, version, json.loads(entry), attempts + 1))
+            conn.executemany(
+                """UPDATE entry_jobs SET state='dead', lease_owner=NULL,
+                   lease_expires=NULL, last_error='租约多次过期', updated_at=?
+                   WHERE entry_id=?""",
+                dead,
+            )
+            conn.executemany(
+                """UPDATE entry_jobs SET state='leased', lease_owner=?, lease_expires=?,
+                   attempts=?, updated_at=? WHERE entry_id=?""",
+                [(owner, expires, job.attempts, now, job.entry_id) for job in jobs],
+            )
+        WORK_QUEUE_JOBS.inc(len(dead), event="dead")
+        WORK_QUEUE_JOBS.inc(len(jobs), event="leased")
+        return jobs
+
+    def ack(self, job, written_time=None):
+        """确认任务已完成，重复确认无副作用
+
+        written_time: 写回后条目的last_edited_time，之后轮询到这个时间的条目不会再入队
+        return: 任务是否仍是这次编辑(期间条目又被编辑时为False，新的编辑会另行处理)"""
+        with self.conn as conn:
+            count = conn.execute(
+                """UPDATE entry_jobs SET state='done', lease_owner=NULL,
+                   lease_expires=NULL, written_time=COALESCE(?, written_time),
+                   last_error=NULL, updated_at=?
+                   WHERE entry_id=? AND version=?""",
+                (written_time, time.time(), job.entry_id, job.version),
+            ).rowcount
+        if count:
+            WORK_QUEUE_JOBS.inc(event="acked")
+        return count > 0
+
+    def fail(self, job, written_time=None, error=None):
+        """任务处理失败: 退避后重试，达到WORK_MAX_ATTEMPTS后标记为dead
+
+        return: 是否还会重试"""
+        now = time.time()
+        retry = job.attempts < WORK_MAX_ATTEMPTS
+        with self.conn as conn:
+            conn.execute(
+                """UPDATE entry_jobs SET state=?, available_at=?, lease_owner=NULL,
+                   lease_expires=NULL, written_time=COALESCE(?, written_time),
+                   last_error=?, updated_at=?
+                   WHERE entry_id=? AND version=? AND state='leased'""",
+                (
+                    PENDING if retry else DEAD,
+                    now + backoff_delay(job.attempts, base=5, cap=300),
+                    written_time,
+                    error,
+                    now,
+                    job.entry_id,
+                    job.version,
+                ),
+            )
+        WORK_QUEUE_JOBS.inc(event="failed" if retry else "dead")
+        return retry
+
+    def prune(self, retention=WORK_QUEUE_RETENTION):
+        """删除完成时间早于retention秒前的已完成任务"""
+        with self.conn as conn:
+            return conn.execute(
+                "DELETE FROM entry_jobs WHERE state='done' AND updated_at < ?",
+                (time.time() - retention,),
+            ).rowcount
+
+    def stats(self):
+        """各状态的任务数和最早未完成任务的等待时间，同时更新指标
+
+        return: {"pending": n, "leased": n, "done": n, "dead": n, "oldest_age": 秒}"""
+        now = time.time()
+        conn = self.conn
+        stats = {PENDING: 0, LEASED: 0, DONE: 0, DEAD: 0}
+        stats.update(
+            conn.execute("SELECT state, COUNT(*) FROM entry_jobs GROUP BY state")
+        )
+        (oldest,) = conn.execute(
+            "SELECT MIN(enqueued_at) FROM entry_jobs WHERE state IN ('pending', 'leased')"
+        ).fetchone()
+        stats["oldest_age"] = now - oldest if oldest else 0.0
+        for state in (PENDING, LEASED, DONE, DEAD):
+            WORK_QUEUE_DEPTH.set(stats[state], state=state)
+        WORK_QUEUE_OLDEST_AGE.set(stats["oldest_age"])
+        return stats
+
+
+_work_queue = None
+_work_queue_lock = threading.Lock()
+
+
+def get_work_queue():
+    """进程内共享的WorkQueue"""
+    global _work_queue
+    with _work_queue_lock:
+        if _work_queue is None:
+            _work_queue = WorkQueue()
+        return _work_queue
+
+
+if __name__ == "__main__":
+    print(get_work_queue().stats())